@@ -1,11 +1,13 @@
 """
 Flask application factory
 """
-from flask import Flask, request
+from flask import Flask, request, g
 from flask_cors import CORS
 from app.config import config_by_name
 from mongoengine import connect
 from app.utils.logging_config import logger, log_request
+from app.utils.deadline import http_deadline, set_deadline, reset_deadline
+from app.utils.tracing import configure_tracing, start_span, end_span, TRACEPARENT_HEADER
 
 
 def create_app(config_name='development'):
@@ -21,6 +23,8 @@ def create_app(config_name='development'):
     # CORS(app, origins="http://localhost:3000",
     #         allow_headers=["Content-Type", "Authorization", "Access-Control-Allow-Credentials"],
     #         supports_credentials=True)
+    # registers the Mongo command listener, must run before connect()
+    configure_tracing()
     connect(
     db=app.config.get('MONGODB_DB', 'devopsshowcase'),
     username=app.config.get('MONGODB_USER', 'appuser'),
@@ -31,11 +35,62 @@ def create_app(config_name='development'):
     )
     logger.info(f"Connected to MongoDB: {app.config.get('MONGODB_HOST')}:{app.config.get('MONGODB_PORT')}/{app.config.get('MONGODB_DB')}")
 
+    from app.models import upgrade_stock_collection
+    try:
+        upgrade_stock_collection()
+    except Exception as err:
+        logger.error(f"Could not upgrade the stock collection | error={err}")
+
+    # Autocomplete index, kept in memory and updated by create/update/delete
+    from app.services.suggest_index import suggest_index
+    suggest_index.refresh_seconds = app.config.get('SUGGEST_REFRESH_S', 60)
+    try:
+        suggest_index.build()
+    except Exception as err:
+        logger.error(f"Could not build suggest index, will retry on refresh | error={err}")
+
+    # Tracing: one span per request, continued from the caller's traceparent header
+    @app.before_request
+    def start_request_span():
+        g.trace_span, g.trace_token = start_span(
+            f"HTTP {request.method} {request.path}",
+            traceparent=request.headers.get(TRACEPARENT_HEADER),
+            attributes={"http.method": request.method, "http.path": request.path}
+        )
+
+    @app.after_request
+    def tag_request_span(response):
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            response.headers[TRACEPARENT_HEADER] = span.traceparent
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc=None):
+        span = g.pop('trace_span', None)
+        if span is not None:
+            if exc is not None:
+                span.set_error(f"{type(exc).__name__}: {exc}")
+            end_span(span, g.pop('trace_token'))
+
     # Request logging middleware
     @app.before_request
     def log_request_info():
         log_request(request.path, request.method, request.get_json(silent=True))
 
+    # Deadline propagation: every stock_service call made for this request shares its deadline
+    @app.before_request
+    def start_request_deadline():
+        deadline = http_deadline(request.headers, app.config.get('DEFAULT_REQUEST_TIMEOUT_MS', 0))
+        g.deadline_token = set_deadline(deadline)
+
+    @app.teardown_request
+    def clear_request_deadline(exc=None):
+        token = g.pop('deadline_token', None)
+        if token is not None:
+            reset_deadline(token)
+
     # Register blueprints
     from app.routes.stock_routes import stock_bp
     app.register_blueprint(stock_bp, url_prefix='/api/stocks')
@@ -17,6 +17,12 @@ class Config:
     MONGODB_PASSWORD=os.getenv('MONGODB_PASSWORD')
     MONGODB_AUTH_SOURCE=os.getenv('MONGODB_AUTH_SOURCE', 'devopsshowcase')
 
+    # Budget for requests that don't send X-Request-Deadline / X-Request-Timeout-Ms (0 = none)
+    DEFAULT_REQUEST_TIMEOUT_MS = int(os.getenv('DEFAULT_REQUEST_TIMEOUT_MS', 0))
+
+    # Seconds between background rebuilds of the autocomplete index (0 = never)
+    SUGGEST_REFRESH_S = int(os.getenv('SUGGEST_REFRESH_S', 60))
+
     # Security
     SESSION_COOKIE_SECURE = True
     SESSION_COOKIE_HTTPONLY = True
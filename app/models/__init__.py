@@ -2,6 +2,6 @@
 Models package initialization
 """
 
-from app.models.stock import Stock
+from app.models.stock import Stock, LocationStock, upgrade_stock_collection
 
-__all__ = ['Stock']
+__all__ = ['Stock', 'LocationStock', 'upgrade_stock_collection']
@@ -2,15 +2,60 @@
 Inventory_Item model for managing stock
 """
 from typing import Any
-from mongoengine import Document, StringField, IntField, FloatField
+from mongoengine import Document, EmbeddedDocument, StringField, IntField, FloatField, DateTimeField, MapField, EmbeddedDocumentField, BooleanField, ListField, DictField, queryset_manager
 from datetime import datetime
+from pymongo.errors import OperationFailure
+
+class LocationStock(EmbeddedDocument):
+    """Quantities held at one warehouse"""
+    available = IntField(default=0, min_value=0)
+    reserved = IntField(default=0, min_value=0)
 
 class Stock(Document):
     id: Any
-    product_name = StringField(required=True, unique=True)
+    # unique among products that aren't soft deleted, see the product_name_live index
+    product_name = StringField(required=True)
     available_quantity = IntField(required=True, default=0, min_value=0)
     reserved_quantity= IntField(default=0, min_value=0)
     price=FloatField(default=0,min_value=0)
+    # last modification time, used by incremental snapshots
+    # writes that bypass save() (bulk_write / update_many) must set it themselves
+    updated_at = DateTimeField(default=datetime.utcnow)
+    # per warehouse quantities keyed by location code
+    # available_quantity / reserved_quantity are kept equal to their sums on every write
+    locations = MapField(EmbeddedDocumentField(LocationStock))
+    # transactional outbox (see app/services/outbox.py): change events not yet
+    # published, appended in the same update as the change they describe
+    outbox = ListField(DictField())
+    # number of events ever recorded for this product
+    version = IntField(default=0)
+    # soft deleted, removed by the outbox relay once its DELETED event is published
+    deleted = BooleanField(default=False)
+
+    meta = {
+        'indexes': [
+            'updated_at',
+            {'fields': ['outbox.event_id'], 'sparse': True},
+            # a deleted product keeps its document until the relay publishes its
+            # DELETED event, its name can be reused straight away
+            {
+                'fields': ['product_name'],
+                'unique': True,
+                'name': 'product_name_live',
+                'partialFilterExpression': {'deleted': False}
+            },
+        ]
+    }
+
+    @queryset_manager
+    def objects(doc_cls, queryset):
+        """Products that aren't soft deleted, without their outbox"""
+        return queryset.filter(deleted__ne=True).exclude('outbox')
+
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.utcnow()
+        return super().save(*args, **kwargs)
+
     def to_dict(self):
         """Convert to dictionary"""
         return {
@@ -18,5 +63,27 @@ class Stock(Document):
             'product_name': str(self.product_name),
             'available_quantity': self.available_quantity,
             'reserved_quantity': self.reserved_quantity,
-            'price':self.price
+            'price':self.price,
+            'locations': {
+                code: {'available_quantity': location.available, 'reserved_quantity': location.reserved}
+                for code, location in (self.locations or {}).items()
+            }
         }
+
+
+def upgrade_stock_collection():
+    """
+    Bring a Stock collection created by an older version up to date.
+
+    Documents written before soft deletes get deleted=False so the partial
+    product_name_live index covers them, then the old unconditional unique
+    index on product_name is dropped. Safe to run from every process.
+    """
+    collection = Stock._get_collection()
+    collection.update_many({'deleted': {'$exists': False}}, {'$set': {'deleted': False}})
+    if 'product_name_1' in collection.index_information():
+        try:
+            collection.drop_index('product_name_1')
+        except OperationFailure:
+            # dropped by another process in the meantime
+            pass
@@ -16,11 +16,19 @@ class QuerySet(Generic[T], Iterator[T]):
     def order_by(self, *keys: str) -> "QuerySet[T]": ...
     def limit(self, n: int) -> "QuerySet[T]": ...
     def skip(self, n: int) -> "QuerySet[T]": ...
+    def exclude(self, *fields: str) -> "QuerySet[T]": ...
     def __call__(self, **kwargs: Any) -> "QuerySet[T]": ...
     def __iter__(self) -> Iterator[T]: ...
     def __len__(self) -> int: ...
     def __getitem__(self, index: int) -> T: ...
 
+class LocationStock:
+    """Per warehouse quantities"""
+    available: int
+    reserved: int
+
+    def __init__(self, available: int = ..., reserved: int = ...) -> None: ...
+
 class Stock:
     """Cart document model"""
     # MongoDB injected fields
@@ -31,6 +39,11 @@ class Stock:
     available_quantity : int
     reserved_quantity:int
     price:float
+    updated_at: datetime
+    locations: dict[str, LocationStock]
+    outbox: list[dict[str, Any]]
+    version: int
+    deleted: bool
     # Class-level attributes injected by mongoengine
     objects: ClassVar[QuerySet["Stock"]]
 
@@ -40,6 +53,11 @@ class Stock:
         available_quantity:int = ...,
         reserved_quantity:int = ...,
         price: float | None = ...,
+        updated_at: datetime | None = ...,
+        locations: dict[str, LocationStock] | None = ...,
+        outbox: list[dict[str, Any]] | None = ...,
+        version: int = ...,
+        deleted: bool = ...,
     ) -> None: ...
 
     def get_total(self) -> float: ...
@@ -50,3 +68,6 @@ class Stock:
     def to_mongo(self) -> dict[str, Any]: ...
     def validate(self) -> None: ...
     def clean(self) -> None: ...
+
+
+def upgrade_stock_collection() -> None: ...
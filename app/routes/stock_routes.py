@@ -9,12 +9,18 @@ stock_bp = Blueprint('stock', __name__)
 error_map = {
     "NOT_UNIQUE_ERROR": 400,
     "VALIDATION_ERROR": 409,
-    "NOT_FOUND": 404
+    "NOT_FOUND": 404,
+    "TIMEOUT": 504,
+    "WRONG_PARTITION": 421
 }
 
 @stock_bp.route('', methods=['GET'])
 def get_stock():
-    """Get all products in stock"""
+    """Get all products in stock, or only the ones listed in ?ids=a,b,c"""
+    ids = request.args.get('ids')
+    if ids is not None:
+        return lookup_response([product_id for product_id in ids.split(',') if product_id])
+
     result = get_all_stock()
 
     if result["ok"]:
@@ -26,7 +32,54 @@ def get_stock():
         return jsonify({
             'success': False,
             'message': result['message']
-        }), 500
+        }), error_map.get(result.get("error", ""), 500)
+
+
+@stock_bp.route('/suggest', methods=['GET'])
+def suggest_products():
+    """Autocomplete product names, ?q=<prefix>&limit=<k>"""
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    result = suggest_stock(request.args.get('q', ''), limit)
+
+    if result["ok"]:
+        return jsonify({
+            'success': True,
+            'suggestions': result['suggestions']
+        }), 200
+    else:
+        return jsonify({
+            'success': False,
+            'message': result['message']
+        }), error_map.get(result.get("error", ""), 500)
+
+
+@stock_bp.route('/lookup', methods=['POST'])
+def lookup_products():
+    """Get several products by id, body: {"ids": [...]}"""
+    data = request.get_json() or {}
+    ids = data.get("ids")
+    if not isinstance(ids, list):
+        return jsonify({
+            'success': False,
+            'message': "ids must be a list"
+        }), 400
+    return lookup_response(ids)
+
+
+def lookup_response(ids):
+    result = get_stocks_by_ids(ids)
+
+    if result["ok"]:
+        return jsonify({
+            'success': True,
+            'products': result['products'],
+            'not_found': result['not_found']
+        }), 200
+    else:
+        return jsonify({
+            'success': False,
+            'message': result['message']
+        }), error_map.get(result.get("error", ""), 500)
 
 
 @stock_bp.route('/<product_id>', methods=['GET'])
@@ -57,7 +110,9 @@ def get_product(product_id):
 def add_product():
     data = request.get_json() or {}
     price = data.get("price", 0)
-    result = create_stock(data["product_name"], data["amount"], price)
+    locations = data.get("locations")
+    amount = data["amount"] if locations is None else None
+    result = create_stock(data["product_name"], amount, price, locations)
 
     if not result["ok"]:
         return jsonify({
@@ -88,6 +143,45 @@ def update_product(product_id):
         }), error_map.get(result.get("error", ""), 500)
 
 
+@stock_bp.route('/bulk', methods=['POST'])
+def bulk_update_products():
+    """
+    Update many products at once.
+
+    Body is either {"updates": [{product_id, price, available_quantity}, ...]}
+    or {"filter": {"price_lt": 10}, "update": {"field": "price", "multiply": 1.05}}
+    """
+    data = request.get_json() or {}
+
+    if isinstance(data.get("updates"), list):
+        result = bulk_update_stock(data["updates"])
+        if result["ok"]:
+            return jsonify({
+                'success': True,
+                'message': result['message'],
+                'results': result['results']
+            }), 200
+    elif isinstance(data.get("filter"), dict) and isinstance(data.get("update"), dict):
+        result = reprice_stock(data["filter"], data["update"])
+        if result["ok"]:
+            return jsonify({
+                'success': True,
+                'message': result['message'],
+                'matched': result['matched'],
+                'modified': result['modified']
+            }), 200
+    else:
+        return jsonify({
+            'success': False,
+            'message': "body needs either 'updates' or 'filter' and 'update'"
+        }), 400
+
+    return jsonify({
+        'success': False,
+        'message': result['message']
+    }), error_map.get(result.get("error", ""), 500)
+
+
 @stock_bp.route('/<product_id>', methods=['DELETE'])
 def delete_product(product_id):
     """Delete a product from stock"""
@@ -5,7 +5,11 @@ from app.services.stock_service import (
     create_stock,
     get_all_stock,
     get_stock_by_id,
+    get_stocks_by_ids,
+    suggest_stock,
     update_stock,
+    bulk_update_stock,
+    reprice_stock,
     reserve_stock,
     unreserve_stock,
     delete_stock,
@@ -16,7 +20,11 @@ __all__ = [
     'create_stock',
     'get_all_stock',
     'get_stock_by_id',
+    'get_stocks_by_ids',
+    'suggest_stock',
     'update_stock',
+    'bulk_update_stock',
+    'reprice_stock',
     'reserve_stock',
     'unreserve_stock',
     'delete_stock',
@@ -0,0 +1,655 @@
+"""
+In-memory single-writer inventory engine
+
+Optional engine for high volume deployments. The worker keeps the
+authoritative available/reserved counters for a set of hash partitions in
+process memory and applies reserve / unreserve / finalise / add without a
+Mongo round trip.
+
+- Counters live in slot-based arrays (PartitionCounters), not documents.
+- Each partition has one asyncio loop thread that is the only writer.
+- Every change is appended to a per-partition write-ahead log. Operations
+  queued while the previous batch was being written are committed together
+  with a single fsync (group commit) before callers get their result.
+- A persister on the same loop writes the latest counters back to the
+  Stock collection with bulk_write. The WAL is split in segments: each
+  persist starts a new one, and segments whose records have all reached
+  Mongo are deleted, so the log stays small under sustained traffic.
+  Each written product gets one ENGINE_SYNC outbox event with its
+  counters, covering every operation since the previous write.
+- On startup counters are rebuilt from Mongo and the WAL is replayed.
+- If a group commit fails (disk full, I/O error) its batch is rolled back
+  and failed, and the partition refuses every operation until the worker
+  is restarted.
+
+Products split across locations are left out: the engine only has totals
+and writing them back would break totals == sum of locations. is_split()
+tells stock_service to use the Mongo location path for them.
+
+WAL records hold absolute counter values, so replaying them is idempotent.
+The engine is only safe when exactly one process owns each partition and
+quantity changes go through the stock tasks, see README. Processes that
+don't run the engine (Flask) use engine_enabled() to refuse quantity
+writes the engine would overwrite.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from array import array
+from concurrent.futures import Future
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.models.stock import Stock
+from app.services.outbox import EVENT_UPDATED, LIVE, new_event, change_pipeline
+from app.utils.deadline import TIMEOUT_ERROR, get_deadline
+from app.utils.logging_config import logger, log_error, log_stock_change
+from app.utils.partitioning import partition_for
+
+WRONG_PARTITION_ERROR = "WRONG_PARTITION"
+
+# operation -> name used in stock change logs ("set" is logged by update_stock)
+OPERATIONS = {
+    "reserve": "RESERVE",
+    "unreserve": "UNRESERVE",
+    "finalise": "FINALIZE_PURCHASE",
+    "add": "ADD_STOCK",
+}
+
+NOT_FOUND_RESULT = {
+    "ok": False,
+    "error": "NOT_FOUND",
+    "message": "Product not found"
+}
+
+WRONG_PARTITION_RESULT = {
+    "ok": False,
+    "error": WRONG_PARTITION_ERROR,
+    "message": "Product belongs to a partition owned by another worker"
+}
+
+TIMEOUT_RESULT = {
+    "ok": False,
+    "error": TIMEOUT_ERROR,
+    "message": "Deadline exceeded before the inventory engine applied the operation"
+}
+
+SPLIT_PRODUCT_RESULT = {
+    "ok": False,
+    "error": "VALIDATION_ERROR",
+    "message": "product is split across locations and not handled by the inventory engine"
+}
+
+_engine = None
+
+
+class PartitionCounters:
+    """Slot-based counters for the products of one partition"""
+
+    __slots__ = ("slots", "ids", "available", "reserved")
+
+    def __init__(self):
+        self.slots = {}            # product_id -> slot index
+        self.ids = []              # slot index -> product_id
+        self.available = array("q")
+        self.reserved = array("q")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, product_id):
+        return product_id in self.slots
+
+    def load(self, product_id, available, reserved):
+        """Insert or overwrite the counters of a product"""
+        slot = self.slots.get(product_id)
+        if slot is None:
+            self.slots[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            self.available.append(available)
+            self.reserved.append(reserved)
+        else:
+            self.available[slot] = available
+            self.reserved[slot] = reserved
+
+    def remove(self, product_id):
+        """Free a slot by moving the last record into it"""
+        slot = self.slots.pop(product_id, None)
+        if slot is None:
+            return
+        last = len(self.ids) - 1
+        if slot != last:
+            moved = self.ids[last]
+            self.ids[slot] = moved
+            self.available[slot] = self.available[last]
+            self.reserved[slot] = self.reserved[last]
+            self.slots[moved] = slot
+        self.ids.pop()
+        self.available.pop()
+        self.reserved.pop()
+
+    def snapshot(self, product_id):
+        slot = self.slots[product_id]
+        return self.available[slot], self.reserved[slot]
+
+
+def _product(product_id, available, reserved):
+    """Product payload returned by engine operations (counters only)"""
+    return {
+        "product_id": product_id,
+        "available_quantity": available,
+        "reserved_quantity": reserved
+    }
+
+
+def apply_operation(counters, op, product_id, amount):
+    """
+    Apply one operation to the counters.
+
+    Mirrors the checks and messages of the Mongo backed functions in
+    stock_service. Returns (result, changed).
+    """
+    if product_id not in counters:
+        return NOT_FOUND_RESULT, False
+
+    slot = counters.slots[product_id]
+    available = counters.available[slot]
+    reserved = counters.reserved[slot]
+
+    if op == "reserve":
+        if amount <= 0:
+            return {"ok": False, "error": "", "message": "cannot reserve with 0 or less"}, False
+        if available < amount:
+            return {
+                "ok": False,
+                "error": "INSUFFICIENT_STOCK",
+                "message": f"Insufficient stock. Available: {available}, Requested: {amount}"
+            }, False
+        available -= amount
+        reserved += amount
+        message = "Product updated successfully"
+    elif op == "unreserve":
+        if amount <= 0:
+            return {"ok": False, "error": "", "message": "cannot unreserve with 0 or less"}, False
+        if reserved < amount:
+            return {"ok": False, "error": "", "message": "cannot unreserve more than reserved"}, False
+        available += amount
+        reserved -= amount
+        message = "Product updated successfully"
+    elif op == "finalise":
+        if reserved < amount:
+            return {"ok": False, "message": "finalised amount doesn't match reserved stock"}, False
+        reserved -= amount
+        message = "Stock purchase finalized successfully"
+    elif op == "add":
+        if amount <= 0:
+            return {"ok": False, "error": "", "message": "cannot add 0 or less stock"}, False
+        available += amount
+        message = "Stock added successfully"
+    elif op == "set":
+        if amount < 0:
+            return {"ok": False, "error": "VALIDATION_ERROR", "message": "available_quantity cannot be negative"}, False
+        available = amount
+        message = "Product updated successfully"
+    else:
+        raise ValueError(f"Unknown engine operation: {op}")
+
+    counters.available[slot] = available
+    counters.reserved[slot] = reserved
+    return {
+        "ok": True,
+        "message": message,
+        "product": _product(product_id, available, reserved)
+    }, True
+
+
+def persist_counters(changes):
+    """Write the latest counters of several products to the Stock collection, with their outbox events"""
+    operations = [
+        UpdateOne(
+            {"_id": ObjectId(product_id), **LIVE},
+            change_pipeline(
+                new_event(EVENT_UPDATED, "ENGINE_SYNC"),
+                set_fields={"available_quantity": available, "reserved_quantity": reserved}
+            )
+        )
+        for product_id, (available, reserved) in changes.items()
+    ]
+    if operations:
+        Stock._get_collection().bulk_write(operations, ordered=False)
+
+
+def fetch_counters(product_id):
+    """Read (available, reserved, split across locations) of one product from Mongo, None if it doesn't exist"""
+    if not ObjectId.is_valid(product_id):
+        return None
+    doc = Stock._get_collection().find_one(
+        {"_id": ObjectId(product_id), **LIVE},
+        {"available_quantity": 1, "reserved_quantity": 1, "locations": 1}
+    )
+    if doc is None:
+        return None
+    return doc.get("available_quantity", 0), doc.get("reserved_quantity", 0), bool(doc.get("locations"))
+
+
+class EnginePartition:
+    """One partition: counters, WAL and the single writer loop that owns them"""
+
+    def __init__(self, index, wal_path, group_commit_ms=0, group_commit_size=512, persist_retry_s=1.0):
+        self.index = index
+        self.wal_path = wal_path
+        self.group_commit_ms = group_commit_ms
+        self.group_commit_size = group_commit_size
+        self.persist_retry_s = persist_retry_s
+
+        self.counters = PartitionCounters()
+        self.seq = 0
+        self.persisted_seq = 0
+        self.dirty = {}
+        # products split across locations, left to Mongo
+        self.split = set()
+        self.wal = None
+        # WAL segments: the open one and closed ones as (number, last seq), oldest first
+        self.segment = 0
+        self.segment_last_seq = None
+        self.closed_segments = []
+        # set when the WAL can't be written, every operation is refused from then on
+        self.failed = None
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=f"inventory-engine-{index}", daemon=True)
+        self._ready = threading.Event()
+        self.queue = None
+        self._dirty_event = None
+
+    # lifecycle
+
+    def start(self, rows, split=()):
+        """
+        Load counters from (product_id, available, reserved) rows, replay the WAL and start the writer.
+
+        split lists the products of the partition held across locations.
+        """
+        for product_id, available, reserved in rows:
+            self.counters.load(product_id, available, reserved)
+        self.split.update(split)
+        replayed, last_segment = self._replay_wal()
+        self._open_segment(last_segment + 1)
+        self.thread.start()
+        self._ready.wait()
+        logger.info(f"Inventory engine partition started | partition={self.index} | products={len(self.counters)} | wal_replayed={replayed}")
+
+    def stop(self, timeout=10):
+        """Finish queued operations, persist everything and stop the loop"""
+        if not self.thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout)
+        self.thread.join(timeout)
+        self.wal.close()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+
+    async def _main(self):
+        self.queue = asyncio.Queue()
+        self._dirty_event = asyncio.Event()
+        self._stopping = asyncio.Event()
+        writer = asyncio.ensure_future(self._writer())
+        persister = asyncio.ensure_future(self._persister())
+        self._ready.set()
+        await self._stopping.wait()
+        writer.cancel()
+        persister.cancel()
+
+    async def _shutdown(self):
+        while not self.queue.empty() or self.dirty:
+            self._dirty_event.set()
+            await asyncio.sleep(0.01)
+        self._stopping.set()
+
+    def _segment_path(self, number):
+        return f"{self.wal_path}.{number:08d}"
+
+    def _segments(self):
+        """Numbers of the WAL segments on disk, oldest first"""
+        directory, prefix = os.path.split(self.wal_path)
+        numbers = []
+        for name in os.listdir(directory or "."):
+            suffix = name[len(prefix) + 1:]
+            if name.startswith(prefix + ".") and suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def _open_segment(self, number):
+        self.segment = number
+        self.segment_last_seq = None
+        # unbuffered: a failed group commit leaves nothing behind to be flushed later
+        self.wal = open(self._segment_path(number), "ab", buffering=0)
+
+    def _rotate_wal(self):
+        """Close the open segment if it has records and start the next one"""
+        if self.segment_last_seq is None or self.failed is not None:
+            return
+        self.wal.close()
+        self.closed_segments.append((self.segment, self.segment_last_seq))
+        self._open_segment(self.segment + 1)
+
+    def _drop_persisted_segments(self):
+        """Delete closed segments whose records are all in Mongo"""
+        while self.closed_segments and self.closed_segments[0][1] <= self.persisted_seq:
+            number, _ = self.closed_segments.pop(0)
+            os.remove(self._segment_path(number))
+
+    def _replay_wal(self):
+        """
+        Apply WAL records left by a previous run and write them to Mongo.
+
+        Returns (products replayed, number of the last segment found).
+        """
+        segments = self._segments()
+        paths = [self._segment_path(number) for number in segments]
+        changes = {}
+        for path in paths:
+            with open(path, encoding="utf-8") as wal:
+                for line in wal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the log, the op was never acknowledged
+                        break
+                    if record["pid"] in self.counters:
+                        self.counters.load(record["pid"], record["a"], record["r"])
+                        changes[record["pid"]] = (record["a"], record["r"])
+        persist_counters(changes)
+        for path in paths:
+            os.remove(path)
+        return len(changes), segments[-1] if segments else 0
+
+    # caller side (any thread)
+
+    def is_split(self, product_id):
+        """True when the product is split across locations and not handled by the engine"""
+        if product_id in self.split:
+            return True
+        if product_id in self.counters:
+            return False
+        loaded = fetch_counters(product_id)
+        if loaded is not None and loaded[2]:
+            self.split.add(product_id)
+            return True
+        return False
+
+    def submit(self, op, product_id, amount, deadline=None):
+        """
+        Queue an operation and return a Future resolved after its group commit.
+
+        An operation still queued at its monotonic deadline is skipped and
+        resolved with TIMEOUT_RESULT instead of being applied.
+        """
+        future = Future()
+        if self.failed is not None:
+            future.set_exception(self.failed)
+            return future
+        loaded = None
+        if product_id not in self.counters and op != "evict":
+            # product created after startup: read it once, the writer inserts it if still absent
+            loaded = fetch_counters(product_id)
+            if loaded is None:
+                future.set_result(NOT_FOUND_RESULT)
+                return future
+            if loaded[2]:
+                self.split.add(product_id)
+                future.set_result(SPLIT_PRODUCT_RESULT)
+                return future
+            loaded = loaded[:2]
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (op, product_id, amount, loaded, deadline, future))
+        return future
+
+    # writer loop (partition thread only)
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        wait_until = self.loop.time() + self.group_commit_ms / 1000
+        while len(batch) < self.group_commit_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = wait_until - self.loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _fail(self, err, undo, seq):
+        """Roll back a batch whose group commit failed and refuse every later operation"""
+        for product_id, (counters, dirty) in undo.items():
+            if counters is None:
+                self.counters.remove(product_id)
+            else:
+                self.counters.load(product_id, *counters)
+            if dirty is None:
+                self.dirty.pop(product_id, None)
+            else:
+                self.dirty[product_id] = dirty
+        self.seq = seq
+        self.failed = RuntimeError(f"Inventory engine partition {self.index} stopped, its WAL can't be written: {err}")
+        self.failed.__cause__ = err
+        log_error("inventory_engine.wal", err, {"partition": self.index, "segment": self.segment})
+
+    async def _writer(self):
+        while True:
+            batch = await self._next_batch()
+            if self.failed is not None:
+                for *_, future in batch:
+                    future.set_exception(self.failed)
+                continue
+
+            replies = []
+            records = []
+            # state before the batch, restored if its group commit fails
+            undo = {}
+            seq = self.seq
+            now = time.monotonic()
+            for op, product_id, amount, loaded, deadline, future in batch:
+                if deadline is not None and now >= deadline:
+                    replies.append((future, TIMEOUT_RESULT))
+                    continue
+                if product_id not in undo:
+                    before = self.counters.snapshot(product_id) if product_id in self.counters else None
+                    undo[product_id] = (before, self.dirty.get(product_id))
+                if loaded is not None and product_id not in self.counters:
+                    self.counters.load(product_id, *loaded)
+                if op == "evict":
+                    self.counters.remove(product_id)
+                    self.split.discard(product_id)
+                    self.dirty.pop(product_id, None)
+                    replies.append((future, {"ok": True, "message": "Product evicted"}))
+                    continue
+                try:
+                    result, changed = apply_operation(self.counters, op, product_id, amount)
+                except Exception as err:
+                    future.set_exception(err)
+                    continue
+                if changed:
+                    self.seq += 1
+                    available, reserved = self.counters.snapshot(product_id)
+                    records.append(json.dumps({"seq": self.seq, "pid": product_id, "a": available, "r": reserved}))
+                    self.dirty[product_id] = (available, reserved)
+                replies.append((future, result))
+
+            if records:
+                size = None
+                try:
+                    size = os.fstat(self.wal.fileno()).st_size
+                    # group commit: one write and one fsync for the whole batch
+                    self.wal.write(("\n".join(records) + "\n").encode("utf-8"))
+                    os.fsync(self.wal.fileno())
+                except Exception as err:
+                    self._fail(err, undo, seq)
+                    if size is not None:
+                        try:
+                            # don't let a restart replay records nobody was told about
+                            os.truncate(self._segment_path(self.segment), size)
+                        except OSError as truncate_err:
+                            log_error("inventory_engine.wal", truncate_err, {"partition": self.index, "segment": self.segment})
+                    for future, _ in replies:
+                        future.set_exception(self.failed)
+                    continue
+                self.segment_last_seq = self.seq
+                self._dirty_event.set()
+
+            for future, result in replies:
+                future.set_result(result)
+
+    async def _persister(self):
+        while True:
+            await self._dirty_event.wait()
+            self._dirty_event.clear()
+            if not self.dirty:
+                continue
+            changes, seq = self.dirty, self.seq
+            self.dirty = {}
+            # records written from now on go to a new segment, the closed ones are covered by changes
+            self._rotate_wal()
+            try:
+                await self.loop.run_in_executor(None, persist_counters, changes)
+            except Exception as err:
+                log_error("inventory_engine.persist", err, {"partition": self.index, "products": len(changes)})
+                for product_id, counters in changes.items():
+                    self.dirty.setdefault(product_id, counters)
+                await asyncio.sleep(self.persist_retry_s)
+                self._dirty_event.set()
+                continue
+            self.persisted_seq = seq
+            self._drop_persisted_segments()
+
+
+class InventoryEngine:
+    """The partitions owned by this process"""
+
+    def __init__(self, partitions, owned, wal_dir, group_commit_ms=0, group_commit_size=512):
+        self.partitions = partitions
+        self.owned = {
+            index: EnginePartition(
+                index,
+                os.path.join(wal_dir, f"partition-{index}.wal"),
+                group_commit_ms=group_commit_ms,
+                group_commit_size=group_commit_size
+            )
+            for index in owned
+        }
+        self.wal_dir = wal_dir
+
+    def start(self):
+        """Rebuild the owned partitions from Mongo and start their writers"""
+        os.makedirs(self.wal_dir, exist_ok=True)
+        rows = {index: [] for index in self.owned}
+        split = {index: [] for index in self.owned}
+        cursor = Stock._get_collection().find(LIVE, {"available_quantity": 1, "reserved_quantity": 1, "locations": 1})
+        for doc in cursor:
+            product_id = str(doc["_id"])
+            index = partition_for(product_id, self.partitions)
+            if index not in rows:
+                continue
+            if doc.get("locations"):
+                split[index].append(product_id)
+            else:
+                rows[index].append((product_id, doc.get("available_quantity", 0), doc.get("reserved_quantity", 0)))
+        for index, partition in self.owned.items():
+            partition.start(rows[index], split[index])
+
+    def stop(self):
+        for partition in self.owned.values():
+            partition.stop()
+        logger.info("Inventory engine stopped")
+
+    def partition(self, product_id) -> Optional[EnginePartition]:
+        return self.owned.get(partition_for(product_id, self.partitions))
+
+    def is_split(self, product_id):
+        """True for products split across locations, which stock_service keeps on the Mongo path"""
+        product_id = str(product_id)
+        partition = self.partition(product_id)
+        return partition is not None and partition.is_split(product_id)
+
+    def execute(self, op, product_id, amount):
+        """
+        Run an operation on the owning partition and wait for its commit.
+
+        The current deadline travels with the operation: the writer either
+        applies it or skips it with TIMEOUT, and the caller waits for that
+        decision so the result always matches what happened to the counters.
+
+        Returns a result dict shaped like the stock_service functions.
+        """
+        product_id = str(product_id)
+        partition = self.partition(product_id)
+        if partition is None:
+            logger.warning(f"Product not owned by this engine | product_id={product_id} | partition={partition_for(product_id, self.partitions)}")
+            return WRONG_PARTITION_RESULT
+
+        result = partition.submit(op, product_id, amount, get_deadline()).result()
+        if result is TIMEOUT_RESULT:
+            logger.warning(f"Engine operation skipped, deadline exceeded while queued | op={op} | product_id={product_id}")
+
+        if result["ok"] and op in OPERATIONS:
+            product = result["product"]
+            log_stock_change(product_id, OPERATIONS[op], amount, product["available_quantity"], product["reserved_quantity"])
+        return result
+
+    def evict(self, product_id):
+        """Forget a deleted product"""
+        partition = self.partition(str(product_id))
+        if partition is not None:
+            partition.submit("evict", str(product_id), 0).result()
+
+
+ENGINE_MEMORY = "memory"
+
+
+def engine_enabled() -> bool:
+    """
+    True when the deployment runs the in-memory engine (INVENTORY_ENGINE=memory).
+
+    Read from the environment so processes that don't run the engine
+    themselves, like the Flask app, know the counters are owned elsewhere.
+    """
+    return os.getenv("INVENTORY_ENGINE", "mongo") == ENGINE_MEMORY
+
+
+def get_engine() -> Optional[InventoryEngine]:
+    """The engine running in this process, None when the Mongo path is used"""
+    return _engine
+
+
+def start_engine(partitions=1, owned=None, wal_dir="wal", group_commit_ms=0, group_commit_size=512):
+    """Create and start the engine for this process"""
+    global _engine
+    if _engine is not None:
+        return _engine
+    engine = InventoryEngine(
+        partitions,
+        owned if owned is not None else range(partitions),
+        wal_dir,
+        group_commit_ms=group_commit_ms,
+        group_commit_size=group_commit_size
+    )
+    engine.start()
+    _engine = engine
+    logger.info(f"Inventory engine started | partitions={partitions} | owned={sorted(engine.owned)} | wal_dir={wal_dir}")
+    return engine
+
+
+def stop_engine():
+    global _engine
+    if _engine is not None:
+        _engine.stop()
+        _engine = None
@@ -0,0 +1,109 @@
+"""
+Stock change events (transactional outbox)
+
+Every mutation of a Stock document appends an event to the document's own
+outbox array in the same update that changes the stock, and bumps the
+document's version. Both happen in one single-document write, so an event
+exists if and only if the change was applied, with no multi-document
+transaction needed. The outbox relay publishes events to Redis Streams and
+pulls them from the documents afterwards.
+
+Events carry the state after the change (quantities, price, locations).
+Their per-product version is derived by the relay: the outbox always holds
+the last len(outbox) versions, so outbox[i] is version - len(outbox) + 1 + i.
+
+The outbox keeps at most OUTBOX_MAX_EVENTS events per product so a hot
+product's document stays small when the relay is down or paused by
+backpressure. On overflow the oldest unpublished events are dropped:
+consumers see a gap in the product's versions, and since every event
+carries the full state, the newest one still brings them up to date.
+
+With the inventory engine the Mongo counters of the products it holds lag
+behind its memory, so events of writes made outside the engine (price
+changes, deletes) leave available_quantity / reserved_quantity out for
+those products. Their ENGINE_SYNC events carry the counters.
+
+Deletes are soft: the document is flagged deleted with a DELETED event and
+removed by the relay once that event has been published.
+"""
+import os
+import uuid
+
+EVENT_CREATED = "CREATED"
+EVENT_UPDATED = "UPDATED"
+EVENT_DELETED = "DELETED"
+
+# filter excluding soft deleted products waiting for their last event to be published
+LIVE = {"deleted": {"$ne": True}}
+
+# events kept per product until the relay publishes them, older ones are dropped
+MAX_EVENTS = int(os.getenv("OUTBOX_MAX_EVENTS", 100))
+
+# reads never need the outbox, only the relay does
+WITHOUT_OUTBOX = {"outbox": 0}
+
+# fields copied from the document into every event
+STATE_FIELDS = ("product_name", "available_quantity", "reserved_quantity", "price", "locations")
+
+# counters the inventory engine owns for products that aren't split across locations
+COUNTER_FIELDS = ("available_quantity", "reserved_quantity")
+
+
+def new_event(event_type, operation, **data):
+    """
+    Build an event.
+
+    Args:
+        event_type: CREATED, UPDATED or DELETED
+        operation: What happened, e.g. RESERVE, ADD_STOCK, BULK_UPDATE
+        data: Extra details such as amount or location
+    """
+    return {
+        "event_id": uuid.uuid4().hex,
+        "type": event_type,
+        "operation": operation,
+        **data
+    }
+
+
+def event_stages(event, engine_counters=False):
+    """
+    Pipeline stages appending event to the outbox with the post-update state.
+
+    Append after the stages that apply the change itself. With
+    engine_counters the counters are left out unless the product is split
+    across locations, for writes made while the inventory engine runs.
+    """
+    state = {field: f"${field}" for field in STATE_FIELDS}
+    if engine_counters:
+        split = {"$gt": [{"$size": {"$objectToArray": {"$ifNull": ["$locations", {}]}}}, 0]}
+        for field in COUNTER_FIELDS:
+            state[field] = {"$cond": [split, f"${field}", "$$REMOVE"]}
+    state["at"] = "$$NOW"
+    return [
+        {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}},
+        {"$set": {"outbox": {"$slice": [
+            {"$concatArrays": [
+                {"$ifNull": ["$outbox", []]},
+                [{"$mergeObjects": [{"$literal": event}, state]}]
+            ]},
+            -MAX_EVENTS
+        ]}}},
+    ]
+
+
+def change_pipeline(event, set_fields=None, inc_fields=None, engine_counters=False):
+    """
+    Pipeline update applying $set / $inc style changes plus the event.
+
+    Args:
+        event: Event from new_event
+        set_fields: {field: value} set to literal values
+        inc_fields: {field: delta}, dotted paths allowed (locations.PAR.available)
+        engine_counters: See event_stages
+    """
+    changes = {field: {"$literal": value} for field, value in (set_fields or {}).items()}
+    for field, delta in (inc_fields or {}).items():
+        changes[field] = {"$add": [{"$ifNull": [f"${field}", 0]}, delta]}
+    changes["updated_at"] = "$$NOW"
+    return [{"$set": changes}] + event_stages(event, engine_counters)
@@ -0,0 +1,182 @@
+"""
+Outbox relay: publishes stock change events to Redis Streams
+
+Reads the outbox arrays of Stock documents in batches, publishes their
+events with one pipelined round trip of XADDs, then pulls the published
+events from the documents with one bulk_write.
+
+- Events go to stream <stream>.<k> where k = partition_for(product_id, partitions)
+  (just <stream> with a single partition). Consumer groups read each
+  stream with XREADGROUP; one consumer per stream keeps per-product order.
+- Each stream message has product_id, version, type, operation, event_id
+  and data (the whole event as JSON). Delivery is at-least-once: a crash
+  between publishing and pulling republishes the batch, so consumers skip
+  versions they have already applied.
+- Backpressure: while a group is more than max_lag entries behind on a
+  stream, nothing more is published to that stream. Events stay in Mongo
+  until the consumers catch up. Streams are trimmed to about max_len
+  entries, which must be larger than max_lag so only consumed entries go.
+- Only one relay publishes at a time (a Redis lock), otherwise two relays
+  could publish a product's events out of order.
+"""
+import json
+import time
+
+from pymongo import UpdateOne
+from redis.exceptions import LockError, ResponseError
+
+from app.models.stock import Stock
+from app.utils.logging_config import logger, log_error
+from app.utils.partitioning import partition_for
+
+DEFAULT_STREAM = "stock-events"
+
+
+def stream_for(product_id, stream=DEFAULT_STREAM, partitions=1):
+    """Stream carrying the events of a product"""
+    if partitions <= 1:
+        return stream
+    return f"{stream}.{partition_for(product_id, partitions)}"
+
+
+def stream_names(stream=DEFAULT_STREAM, partitions=1):
+    """Every stream events are published to"""
+    if partitions <= 1:
+        return [stream]
+    return [f"{stream}.{index}" for index in range(partitions)]
+
+
+def _message(product_id, version, event):
+    return {
+        "product_id": product_id,
+        "version": version,
+        "type": event.get("type", ""),
+        "operation": event.get("operation", ""),
+        "event_id": event.get("event_id", ""),
+        "data": json.dumps({"product_id": product_id, "version": version, **event}, default=str),
+    }
+
+
+class OutboxRelay:
+    """Moves outbox events from Mongo to Redis Streams in batches"""
+
+    def __init__(self, redis_client, stream=DEFAULT_STREAM, partitions=1, groups=(),
+                 batch_size=500, max_lag=10000, max_len=100000, poll_interval=0.2, lock_timeout=30):
+        if max_len <= max_lag:
+            raise ValueError("max_len must be larger than max_lag, or unread events would be trimmed")
+        self.redis = redis_client
+        self.stream = stream
+        self.partitions = partitions
+        self.groups = list(groups)
+        self.batch_size = batch_size
+        self.max_lag = max_lag
+        self.max_len = max_len
+        self.poll_interval = poll_interval
+        self.lock = redis_client.lock(f"{stream}:relay", timeout=lock_timeout)
+        self._resume_after = None
+
+    def ensure_groups(self):
+        """Create the consumer groups on every stream, reading from the start"""
+        for name in stream_names(self.stream, self.partitions):
+            for group in self.groups:
+                try:
+                    self.redis.xgroup_create(name, group, id="0", mkstream=True)
+                    logger.info(f"Consumer group created | stream={name} | group={group}")
+                except ResponseError as err:
+                    if "BUSYGROUP" not in str(err):
+                        raise
+
+    def lag(self, name):
+        """Entries the slowest consumer group has not acknowledged yet, 0 without groups"""
+        try:
+            groups = self.redis.xinfo_groups(name)
+        except ResponseError:
+            # stream doesn't exist yet
+            return 0
+        worst = 0
+        for group in groups:
+            lag = group.get("lag")
+            if lag is None:
+                # Redis can't tell after some trims / deletions, assume the whole stream
+                lag = self.redis.xlen(name)
+            worst = max(worst, lag + group.get("pending", 0))
+        return worst
+
+    def _pending_docs(self):
+        query = {"outbox.event_id": {"$exists": True}}
+        if self._resume_after is not None:
+            query["_id"] = {"$gt": self._resume_after}
+        docs = list(
+            Stock._get_collection()
+            .find(query, {"outbox": 1, "version": 1, "deleted": 1})
+            .sort("_id", 1)
+            .limit(self.batch_size)
+        )
+        # walk the collection round robin so busy products can't starve the rest
+        self._resume_after = docs[-1]["_id"] if len(docs) == self.batch_size else None
+        return docs
+
+    def relay_once(self):
+        """Publish one batch of events, returns how many were published"""
+        budgets = {name: self.max_lag - self.lag(name) for name in stream_names(self.stream, self.partitions)}
+        if not any(budget > 0 for budget in budgets.values()):
+            logger.warning(f"Outbox relay paused, consumers behind | stream={self.stream} | max_lag={self.max_lag}")
+            return 0
+
+        pipe = self.redis.pipeline(transaction=False)
+        pulls = []
+        tombstones = []
+        published = 0
+        for doc in self._pending_docs():
+            product_id = str(doc["_id"])
+            name = stream_for(product_id, self.stream, self.partitions)
+            events = doc.get("outbox") or []
+            # the outbox holds the last len(outbox) versions of the product
+            first_version = doc.get("version", len(events)) - len(events) + 1
+            take = events[:max(budgets[name], 0)]
+            if not take:
+                continue
+            for offset, event in enumerate(take):
+                pipe.xadd(name, _message(product_id, first_version + offset, event), maxlen=self.max_len, approximate=True)
+            budgets[name] -= len(take)
+            published += len(take)
+            pulls.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$pull": {"outbox": {"event_id": {"$in": [event["event_id"] for event in take]}}}}
+            ))
+            if doc.get("deleted") and len(take) == len(events):
+                tombstones.append(doc["_id"])
+
+        if not pulls:
+            return 0
+        pipe.execute()
+        collection = Stock._get_collection()
+        collection.bulk_write(pulls, ordered=False)
+        if tombstones:
+            collection.delete_many({"_id": {"$in": tombstones}, "deleted": True, "outbox": {"$size": 0}})
+        logger.debug(f"Outbox events published | events={published} | products={len(pulls)} | purged={len(tombstones)}")
+        return published
+
+    def run(self, should_stop=lambda: False):
+        """Relay until should_stop() is true, polling when the outbox is empty"""
+        self.ensure_groups()
+        while not should_stop():
+            if not self.lock.owned():
+                if not self.lock.acquire(blocking=False):
+                    # another relay is publishing
+                    time.sleep(self.poll_interval)
+                    continue
+                logger.info(f"Outbox relay holds the publishing lock | stream={self.stream}")
+            try:
+                self.lock.reacquire()
+                published = self.relay_once()
+            except LockError:
+                logger.warning("Outbox relay lost the publishing lock")
+                continue
+            except Exception as err:
+                log_error("outbox_relay", err, {"stream": self.stream})
+                published = 0
+            if published < self.batch_size:
+                time.sleep(self.poll_interval)
+        if self.lock.owned():
+            self.lock.release()
@@ -1,18 +1,205 @@
 """
 Stock service
 """
+import re
 from datetime import datetime
-from app.models.stock import Stock
+from bson import ObjectId
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from app.models.stock import Stock, LocationStock
 from mongoengine.errors import NotUniqueError, ValidationError
 from app.utils.logging_config import logger, log_error, log_stock_change, log_db_operation
+from app.utils.deadline import deadline_bound, error_code
+from app.utils.tracing import traced
+from app.services.inventory_engine import get_engine, engine_enabled, WRONG_PARTITION_RESULT
+from app.services.suggest_index import suggest_index
+from app.services.outbox import (
+    EVENT_CREATED, EVENT_UPDATED, EVENT_DELETED, LIVE, WITHOUT_OUTBOX, new_event, event_stages, change_pipeline
+)
 
 import uuid
 
-def create_stock(item_name, amount, price=0):
-    """Create a stock"""
+# Allocation strategies for reserve_stock on products held in several warehouses
+STRATEGY_MOST_STOCKED = 'most_stocked'
+STRATEGY_NEAREST = 'nearest'
+ALLOCATION_STRATEGIES = (STRATEGY_MOST_STOCKED, STRATEGY_NEAREST)
+
+ENGINE_OWNS_QUANTITIES = "available_quantity is managed by the inventory engine, change it through the stock tasks"
+ENGINE_OWNS_DELETES = "products are held by the inventory engine, delete them through the stock.delete_stock task"
+
+# location codes become Mongo field names, so no dots or dollar signs
+LOCATION_CODE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def _validation_error(message):
+    return {
+        "ok": False,
+        "error": "VALIDATION_ERROR",
+        "message": message
+    }
+
+
+def _invalid_location_quantities(quantities):
+    """Return an error message when {location: quantity} is malformed, else None"""
+    if not isinstance(quantities, dict) or not quantities:
+        return "locations must be a non-empty object of location code to quantity"
+    for code, quantity in quantities.items():
+        if not LOCATION_CODE.match(str(code)):
+            return f"invalid location code: {code}"
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 0:
+            return f"quantity for {code} must be a non-negative integer"
+    return None
+
+
+def _apply_change(product_id, event, guard=None, set_fields=None, inc_fields=None, engine_counters=False):
+    """
+    Apply a change and append its outbox event in one atomic update.
+
+    Args:
+        product_id: Product to change
+        event: Event from new_event
+        guard: Extra filter conditions, e.g. {'available_quantity': {'$gte': 2}}
+        set_fields / inc_fields / engine_counters: See change_pipeline
+
+    Returns the updated Stock, or None when the product doesn't exist or the guard failed.
+    """
+    query = {'_id': ObjectId(str(product_id)), **LIVE, **(guard or {})}
+    doc = Stock._get_collection().find_one_and_update(
+        query,
+        change_pipeline(event, set_fields, inc_fields, engine_counters),
+        projection=WITHOUT_OUTBOX,
+        return_document=ReturnDocument.AFTER
+    )
+    return Stock._from_son(doc) if doc else None
+
+
+def _move_location_stock(product_id, location, available_delta, reserved_delta, operation, amount):
+    """
+    Change one location's quantities and the product totals in one atomic update.
+
+    The filter guards against either going negative. Returns the updated
+    Stock, or None when the guard failed (someone else took the stock first).
+    """
+    path = f'locations.{location}'
+    guard = {path: {'$exists': True}}
+    inc = {}
+    if available_delta:
+        inc[f'{path}.available'] = available_delta
+        inc['available_quantity'] = available_delta
+        if available_delta < 0:
+            guard[f'{path}.available'] = {'$gte': -available_delta}
+    if reserved_delta:
+        inc[f'{path}.reserved'] = reserved_delta
+        inc['reserved_quantity'] = reserved_delta
+        if reserved_delta < 0:
+            guard[f'{path}.reserved'] = {'$gte': -reserved_delta}
+
+    if not inc:
+        doc = Stock._get_collection().find_one({'_id': ObjectId(str(product_id)), **LIVE, **guard}, WITHOUT_OUTBOX)
+        return Stock._from_son(doc) if doc else None
+    event = new_event(EVENT_UPDATED, operation, amount=amount, location=location)
+    return _apply_change(product_id, event, guard=guard, inc_fields=inc)
+
+
+def _set_location_quantities(product_id, quantities):
+    """
+    Set the available quantity of several locations and recompute the totals.
+
+    A single pipeline update, so totals can't drift from the locations even
+    with reservations running concurrently. It records the outbox event too.
+    """
+    merged = {
+        code: {'$mergeObjects': [
+            {'available': 0, 'reserved': 0},
+            {'$ifNull': [f'$locations.{code}', {}]},
+            {'available': quantity}
+        ]}
+        for code, quantity in quantities.items()
+    }
+    location_values = {'$objectToArray': '$locations'}
+    pipeline = [
+        {'$set': {'locations': {'$mergeObjects': [{'$ifNull': ['$locations', {}]}, merged]}}},
+        {'$set': {
+            'available_quantity': {'$sum': {'$map': {'input': location_values, 'in': '$$this.v.available'}}},
+            'reserved_quantity': {'$sum': {'$map': {'input': location_values, 'in': '$$this.v.reserved'}}},
+            'updated_at': '$$NOW'
+        }}
+    ] + event_stages(new_event(EVENT_UPDATED, "SET_LOCATIONS", changes=quantities))
+    doc = Stock._get_collection().find_one_and_update(
+        {'_id': ObjectId(str(product_id)), **LIVE},
+        pipeline,
+        projection=WITHOUT_OUTBOX,
+        return_document=ReturnDocument.AFTER
+    )
+    return Stock._from_son(doc) if doc else None
+
+
+def _engine_for(product_id, location=None, near=None):
+    """
+    Inventory engine holding a product's counters, None when it goes through Mongo.
+
+    Products split across locations stay on the Mongo path, their totals
+    follow the locations. The engine only keeps totals, so asking it for a
+    location (or a near list) raises ValueError.
+    """
+    engine = get_engine()
+    if engine is None or engine.is_split(product_id):
+        return None
+    if location is not None or near:
+        raise ValueError("per location operations are not supported by the inventory engine")
+    return engine
+
+
+def _allocation_order(stock, amount, strategy, near):
+    """Locations that can cover amount on their own, in the order the strategy prefers"""
+    available = {code: location.available for code, location in stock.locations.items() if location.available >= amount}
+    if strategy == STRATEGY_NEAREST:
+        return [code for code in near or [] if code in available]
+    return sorted(available, key=lambda code: available[code], reverse=True)
+
+
+def _reserved_order(stock, amount, location):
+    """Locations to release / finalise a reservation from"""
+    if location is not None:
+        return [location]
+    reserved = {code: loc.reserved for code, loc in stock.locations.items() if loc.reserved >= amount}
+    return sorted(reserved, key=lambda code: reserved[code], reverse=True)
+
+@traced
+@deadline_bound
+def create_stock(item_name, amount, price=0, locations=None):
+    """
+    Create a stock.
+
+    When locations ({location code: quantity}) is given the product is split
+    across warehouses and amount is their total.
+    """
     try:
-        stock = Stock(product_name=item_name, available_quantity=amount, price=price).save()
+        stock_locations = {}
+        if locations is not None:
+            invalid = _invalid_location_quantities(locations)
+            if invalid:
+                logger.warning(f"Invalid locations for stock creation | product={item_name} | error={invalid}")
+                return _validation_error(invalid)
+            stock_locations = {code: LocationStock(available=quantity) for code, quantity in locations.items()}
+            amount = sum(locations.values())
+
+        # the CREATED event goes in with the document itself
+        event = new_event(
+            EVENT_CREATED, "CREATE",
+            product_name=item_name,
+            available_quantity=amount,
+            reserved_quantity=0,
+            price=price,
+            locations={code: {'available': quantity, 'reserved': 0} for code, quantity in (locations or {}).items()},
+            at=datetime.utcnow()
+        )
+        stock = Stock(
+            product_name=item_name, available_quantity=amount, price=price, locations=stock_locations,
+            outbox=[event], version=1
+        ).save()
         logger.info(f"Stock created | product={item_name} | amount={amount} | price={price} | id={stock.id}")
+        suggest_index.upsert(stock.id, item_name, amount)
         log_db_operation("CREATE", "stocks", str(stock.id))
     except NotUniqueError as err:
         logger.warning(f"Duplicate stock creation attempt | product={item_name}")
@@ -32,6 +219,7 @@ def create_stock(item_name, amount, price=0):
         log_error("create_stock", err, {"product": item_name})
         return{
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
     return {
@@ -40,6 +228,8 @@ def create_stock(item_name, amount, price=0):
     }
 
 
+@traced
+@deadline_bound
 def get_all_stock():
     """Get all products in stock"""
     try:
@@ -53,10 +243,13 @@ def get_all_stock():
         log_error("get_all_stock", err)
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
 
+@traced
+@deadline_bound
 def get_stock_by_id(product_id):
     """Get a specific product by id"""
     try:
@@ -79,10 +272,79 @@ def get_stock_by_id(product_id):
         log_error("get_stock_by_id", err, {"product_id": product_id})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
 
+@traced
+@deadline_bound
+def get_stocks_by_ids(product_ids):
+    """
+    Get several products in one query.
+
+    Runs a single $in query with a projection on the fields used by to_dict.
+    Products are returned in request order (duplicates collapsed) and ids
+    that are malformed or don't exist are listed in not_found.
+
+    Args:
+        product_ids: List of product ids to look up
+    """
+    try:
+        requested = list(dict.fromkeys(str(product_id) for product_id in product_ids))
+        valid_ids = [product_id for product_id in requested if ObjectId.is_valid(product_id)]
+
+        stocks = Stock.objects(id__in=valid_ids).only(
+            'product_name', 'available_quantity', 'reserved_quantity', 'price', 'locations'
+        ) if valid_ids else []
+        found = {str(stock.id): stock.to_dict() for stock in stocks}
+
+        products = [found[product_id] for product_id in requested if product_id in found]
+        not_found = [product_id for product_id in requested if product_id not in found]
+
+        logger.debug(f"Stocks retrieved by ids | requested={len(requested)} | found={len(products)} | not_found={len(not_found)}")
+        return {
+            "ok": True,
+            "products": products,
+            "not_found": not_found
+        }
+    except Exception as err:
+        log_error("get_stocks_by_ids", err, {"count": len(product_ids)})
+        return {
+            "ok": False,
+            "error": error_code(err),
+            "message": str(err)
+        }
+
+
+@traced
+def suggest_stock(prefix, limit=10):
+    """
+    Autocomplete product names.
+
+    Served from the in-memory suggest index, no Mongo query.
+
+    Args:
+        prefix: What the user typed so far
+        limit: Maximum number of in-stock products returned
+    """
+    try:
+        suggestions = suggest_index.suggest(prefix, limit)
+        logger.debug(f"Stock suggestions | prefix={prefix} | count={len(suggestions)}")
+        return {
+            "ok": True,
+            "suggestions": suggestions
+        }
+    except Exception as err:
+        log_error("suggest_stock", err, {"prefix": prefix})
+        return {
+            "ok": False,
+            "message": str(err)
+        }
+
+
+@traced
+@deadline_bound
 def update_stock(product_id, data):
     """Update a product's stock quantity and/or price"""
     try:
@@ -97,48 +359,372 @@ def update_stock(product_id, data):
             }
 
         updated_fields = []
+        set_fields = {}
+        engine = get_engine()
+        engine_product = None
 
-        if 'available_quantity' in data:
+        if 'locations' in data:
+            invalid = _invalid_location_quantities(data['locations'])
+            if invalid:
+                return _validation_error(invalid)
+            if engine is not None or engine_enabled():
+                return _validation_error("per location quantities are not supported by the inventory engine")
+            if not stock.locations and stock.reserved_quantity:
+                return _validation_error("cannot split a product across locations while it has reservations")
+        if 'available_quantity' in data and (stock.locations or 'locations' in data):
+            return _validation_error("product is split across locations, set quantities through locations")
+
+        if 'available_quantity' in data and engine is not None:
+            # counters are owned by the inventory engine, don't write them from here
+            old_qty = stock.available_quantity
+            result = engine.execute("set", product_id, data['available_quantity'])
+            if not result["ok"]:
+                return result
+            engine_product = result["product"]
+            logger.info(f"Stock quantity set through inventory engine | product_id={product_id} | quantity={data['available_quantity']}")
+            log_stock_change(product_id, "UPDATE", data['available_quantity'] - old_qty, engine_product['available_quantity'], engine_product['reserved_quantity'])
+        elif 'available_quantity' in data and engine_enabled():
+            # the engine runs in the workers, its next persist would overwrite a write from here
+            return _validation_error(ENGINE_OWNS_QUANTITIES)
+        elif 'available_quantity' in data:
             old_qty = stock.available_quantity
             stock.available_quantity = data['available_quantity']
+            set_fields['available_quantity'] = data['available_quantity']
             updated_fields.append(f"quantity: {old_qty} -> {data['available_quantity']}")
             log_stock_change(product_id, "UPDATE", data['available_quantity'] - old_qty, stock.available_quantity, stock.reserved_quantity)
 
         if 'price' in data:
             old_price = stock.price
             stock.price = data['price']
+            set_fields['price'] = data['price']
             updated_fields.append(f"price: {old_price} -> {data['price']}")
             logger.info(f"Stock price updated | product_id={product_id} | old_price={old_price} | new_price={data['price']}")
 
         if updated_fields:
-            stock.save()
+            stock.validate()
+            # the Mongo counters lag behind the engine, its ENGINE_SYNC events carry them
+            stock = _apply_change(
+                product_id,
+                new_event(EVENT_UPDATED, "UPDATE", changes=set_fields),
+                set_fields=set_fields,
+                engine_counters=engine_enabled()
+            )
+            if stock is None:
+                return {
+                    "ok": False,
+                    "error": "NOT_FOUND",
+                    "message": "Product not found"
+                }
             logger.info(f"Stock updated | product_id={product_id} | changes: {', '.join(updated_fields)}")
 
+        if 'locations' in data:
+            old_qty = stock.available_quantity
+            stock = _set_location_quantities(product_id, data['locations'])
+            if stock is None:
+                return {
+                    "ok": False,
+                    "error": "NOT_FOUND",
+                    "message": "Product not found"
+                }
+            logger.info(f"Stock location quantities set | product_id={product_id} | locations={data['locations']}")
+            log_stock_change(product_id, "UPDATE", stock.available_quantity - old_qty, stock.available_quantity, stock.reserved_quantity)
+
+        product = stock.to_dict()
+        if engine_product is not None:
+            product.update(engine_product)
+        suggest_index.upsert(product_id, product['product_name'], product['available_quantity'])
+
         return {
             "ok": True,
             "message": "Product updated successfully",
-            "product": stock.to_dict()
+            "product": product
         }
     except Exception as err:
         log_error("update_stock", err, {"product_id": product_id})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
-def reserve_stock(product_id, amount):
+# Fields that can be changed by the bulk operations
+BULK_UPDATE_FIELDS = ('price', 'available_quantity')
+
+# filter key suffix -> mongo operator, e.g. {"price_lt": 10}
+BULK_FILTER_OPERATORS = {
+    'lt': '$lt',
+    'lte': '$lte',
+    'gt': '$gt',
+    'gte': '$gte',
+    'eq': '$eq',
+}
+
+
+def _is_valid_bulk_value(field, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    if field == 'available_quantity' and not isinstance(value, int):
+        return False
+    return value >= 0
+
+
+@traced
+@deadline_bound
+def bulk_update_stock(changes):
+    """
+    Apply explicit price / quantity changes to many products at once.
+
+    Looks up which products exist with one $in query, then sends every
+    change in a single unordered bulk_write. Quantities of products split
+    across locations are rejected, their totals follow the locations.
+    Each update records its own outbox event.
+
+    Args:
+        changes: List of {"product_id", "price"?, "available_quantity"?}
+
+    Returns:
+        Per-item outcomes in request order: updated, not_found, invalid or failed
+    """
+    try:
+        results = []
+        operations = []
+        pending = []
+
+        for change in changes:
+            product_id = str(change.get('product_id', '')) if isinstance(change, dict) else ''
+            fields = {field: change[field] for field in BULK_UPDATE_FIELDS if field in change} if isinstance(change, dict) else {}
+
+            if not ObjectId.is_valid(product_id):
+                results.append({"product_id": product_id, "status": "invalid", "message": "invalid product_id"})
+            elif not fields:
+                results.append({"product_id": product_id, "status": "invalid", "message": "nothing to update"})
+            elif 'available_quantity' in fields and (get_engine() is not None or engine_enabled()):
+                results.append({"product_id": product_id, "status": "invalid", "message": ENGINE_OWNS_QUANTITIES})
+            elif not all(_is_valid_bulk_value(field, value) for field, value in fields.items()):
+                results.append({"product_id": product_id, "status": "invalid", "message": "values must be non-negative numbers"})
+            else:
+                results.append({"product_id": product_id, "status": "updated"})
+                pending.append((len(results) - 1, ObjectId(product_id), fields))
+
+        collection = Stock._get_collection()
+        existing = {}
+        if pending:
+            cursor = collection.find({'_id': {'$in': [oid for _, oid, _ in pending]}, **LIVE}, {'locations': 1})
+            existing = {doc['_id']: bool(doc.get('locations')) for doc in cursor}
+
+        op_indexes = []
+        for index, oid, fields in pending:
+            if oid not in existing:
+                results[index] = {"product_id": str(oid), "status": "not_found", "message": "Product not found"}
+                continue
+            if 'available_quantity' in fields and existing[oid]:
+                results[index] = {"product_id": str(oid), "status": "invalid", "message": "product is split across locations, set quantities through locations"}
+                continue
+            event = new_event(EVENT_UPDATED, "BULK_UPDATE", changes=fields)
+            operations.append(UpdateOne({'_id': oid, **LIVE}, change_pipeline(event, set_fields=fields, engine_counters=engine_enabled())))
+            op_indexes.append(index)
+
+        modified = 0
+        if operations:
+            try:
+                modified = collection.bulk_write(operations, ordered=False).modified_count
+            except BulkWriteError as err:
+                modified = err.details.get('nModified', 0)
+                for write_error in err.details.get('writeErrors', []):
+                    index = op_indexes[write_error['index']]
+                    results[index] = {
+                        "product_id": results[index]["product_id"],
+                        "status": "failed",
+                        "message": write_error.get('errmsg', '')
+                    }
+
+        for index, oid, fields in pending:
+            if 'available_quantity' in fields and results[index]["status"] == "updated":
+                suggest_index.set_quantity(oid, fields['available_quantity'])
+
+        updated = sum(1 for result in results if result["status"] == "updated")
+        logger.info(f"Bulk stock update | requested={len(results)} | updated={updated} | modified={modified}")
+        log_db_operation("BULK_UPDATE", "stocks", None)
+
+        return {
+            "ok": True,
+            "message": f"{updated} of {len(results)} products updated",
+            "results": results
+        }
+    except Exception as err:
+        log_error("bulk_update_stock", err, {"count": len(changes)})
+        return {
+            "ok": False,
+            "error": error_code(err),
+            "message": str(err)
+        }
+
+
+def _build_bulk_filter(filters):
+    # an empty filter would reprice the whole catalogue, that has to be asked for with {"all": true}
+    if filters == {'all': True}:
+        return {}
+    if not filters:
+        raise ValueError("filter is empty, pass {\"all\": true} to update every product")
+    query = {}
+    for key, value in filters.items():
+        field, _, op = key.rpartition('_')
+        if field not in BULK_UPDATE_FIELDS or op not in BULK_FILTER_OPERATORS:
+            raise ValueError(f"unsupported filter: {key}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"filter value for {key} must be a number")
+        query.setdefault(field, {})[BULK_FILTER_OPERATORS[op]] = value
+    return query
+
+
+def _build_bulk_expression(expression):
+    field = expression.get('field', 'price')
+    if field not in BULK_UPDATE_FIELDS:
+        raise ValueError(f"unsupported field: {field}")
+
+    if 'multiply' in expression:
+        operand, op = expression['multiply'], '$multiply'
+    elif 'add' in expression:
+        operand, op = expression['add'], '$add'
+    else:
+        raise ValueError("expression needs 'multiply' or 'add'")
+    if isinstance(operand, bool) or not isinstance(operand, (int, float)):
+        raise ValueError("expression operand must be a number")
+
+    value = {op: [f"${field}", operand]}
+    # prices keep two decimals, quantities stay whole numbers
+    value = {'$round': [value, 2 if field == 'price' else 0]}
+    if field == 'available_quantity':
+        value = {'$toInt': value}
+    # never go below zero (min_value=0 on the model)
+    return field, [{'$set': {field: {'$max': [0, value]}, 'updated_at': '$$NOW'}}]
+
+
+@traced
+@deadline_bound
+def reprice_stock(filters, expression):
+    """
+    Update every product matching a filter with one update_many.
+
+    Every modified product gets an outbox event. They share one event_id,
+    which is only unique per product.
+
+    Args:
+        filters: e.g. {"price_lt": 10}, keys are <field>_<lt|lte|gt|gte|eq>, or {"all": true} for every product
+        expression: e.g. {"field": "price", "multiply": 1.05} or {"field": "available_quantity", "add": 10}
+    """
+    try:
+        query = {**_build_bulk_filter(filters), **LIVE}
+        field, pipeline = _build_bulk_expression(expression)
+        pipeline += event_stages(new_event(EVENT_UPDATED, "REPRICE", expression=expression), engine_counters=engine_enabled())
+        if field == 'available_quantity' and (get_engine() is not None or engine_enabled()):
+            raise ValueError(ENGINE_OWNS_QUANTITIES)
+        if field == 'available_quantity':
+            # totals of products split across locations follow their locations
+            query['$or'] = [{'locations': {'$exists': False}}, {'locations': {}}]
+    except (ValueError, AttributeError) as err:
+        logger.warning(f"Invalid bulk reprice request | filters={filters} | expression={expression} | error={err}")
+        return {
+            "ok": False,
+            "error": "VALIDATION_ERROR",
+            "message": str(err)
+        }
+
+    try:
+        # new quantities are computed server side, the suggest index picks them up on its periodic rebuild
+        result = Stock._get_collection().update_many(query, pipeline)
+        logger.info(f"Bulk stock reprice | filters={filters} | expression={expression} | matched={result.matched_count} | modified={result.modified_count}")
+        log_db_operation("BULK_REPRICE", "stocks", None)
+
+        return {
+            "ok": True,
+            "message": f"{result.modified_count} products updated",
+            "matched": result.matched_count,
+            "modified": result.modified_count
+        }
+    except Exception as err:
+        log_error("reprice_stock", err, {"filters": filters, "expression": expression})
+        return {
+            "ok": False,
+            "error": error_code(err),
+            "message": str(err)
+        }
+
+def _reserve_at_location(stock, amount, strategy, near, location):
+    """Reserve amount from a single location of a product split across warehouses"""
+    product_id = str(stock.id)
+    if location is not None and location not in (stock.locations or {}):
+        return _validation_error(f"product has no stock at location {location}")
+
+    order = [location] if location is not None else _allocation_order(stock, amount, strategy, near)
+    for code in order:
+        updated = _move_location_stock(product_id, code, -amount, amount, "RESERVE", amount)
+        if updated is None:
+            # another reservation got there first, try the next location
+            continue
+        log_stock_change(product_id, "RESERVE", amount, updated.available_quantity, updated.reserved_quantity)
+        logger.info(f"Stock reserved successfully | product_id={product_id} | amount={amount} | location={code} | strategy={strategy} | available={updated.available_quantity} | reserved={updated.reserved_quantity}")
+        return {
+            "ok": True,
+            "message": "Product updated successfully",
+            "product": updated.to_dict(),
+            "location": code
+        }
+
+    logger.warning(f"Insufficient stock at any single location | product_id={product_id} | total_available={stock.available_quantity} | requested={amount}")
+    return {
+        "ok": False,
+        "error": "INSUFFICIENT_STOCK",
+        "message": f"Insufficient stock at any single location. Available: {stock.available_quantity}, Requested: {amount}"
+    }
+
+
+def _release_at_location(stock, amount, location, available_delta, reserved_delta, operation):
+    """Move a reservation out of a location (unreserve or finalise), returns (updated stock, location)"""
+    if location is not None and location not in (stock.locations or {}):
+        return None, location
+    for code in _reserved_order(stock, amount, location):
+        updated = _move_location_stock(str(stock.id), code, available_delta, reserved_delta, operation, amount)
+        if updated is not None:
+            return updated, code
+    return None, location
+
+
+@traced
+@deadline_bound
+def reserve_stock(product_id, amount, strategy=STRATEGY_MOST_STOCKED, near=None, location=None):
     """
     Reserve stock for a product during checkout.
 
     Moves quantity from available_quantity to reserved_quantity.
     Called when a cart begins checkout to hold items.
 
+    For products split across locations the whole amount is taken from one
+    location, in one atomic update of that location and the totals. The
+    chosen location is returned and must be passed back to unreserve /
+    finalise.
+
     Args:
         product_id: ID of the product to reserve
         amount: Quantity to reserve
+        strategy: "most_stocked" or "nearest" (first location in near that can cover amount)
+        near: Location codes ordered nearest first, for the nearest strategy
+        location: Reserve from this location only
     """
     try:
         logger.info(f"Reserving stock | product_id={product_id} | amount={amount}")
+        try:
+            engine = _engine_for(product_id, location, near)
+        except ValueError as err:
+            return _validation_error(str(err))
+        if engine is not None:
+            return engine.execute("reserve", product_id, amount)
+
+        if strategy not in ALLOCATION_STRATEGIES:
+            return _validation_error(f"unknown allocation strategy: {strategy}")
+        if strategy == STRATEGY_NEAREST and not near and location is None:
+            return _validation_error("the nearest strategy needs a near list of locations")
+
         stock = Stock.objects(id=product_id).first()
 
         if not stock:
@@ -157,6 +743,9 @@ def reserve_stock(product_id, amount):
                 "message": "cannot reserve with 0 or less"
             }
 
+        if stock.locations or location is not None:
+            return _reserve_at_location(stock, amount, strategy, near, location)
+
         if stock.available_quantity < amount:
             logger.warning(f"Insufficient stock for reservation | product_id={product_id} | available={stock.available_quantity} | requested={amount}")
             return {
@@ -165,9 +754,19 @@ def reserve_stock(product_id, amount):
                 "message": f"Insufficient stock. Available: {stock.available_quantity}, Requested: {amount}"
             }
 
-        stock.available_quantity-=amount
-        stock.reserved_quantity+=amount
-        stock.save()
+        stock = _apply_change(
+            product_id,
+            new_event(EVENT_UPDATED, "RESERVE", amount=amount),
+            guard={'available_quantity': {'$gte': amount}},
+            inc_fields={'available_quantity': -amount, 'reserved_quantity': amount}
+        )
+        if stock is None:
+            logger.warning(f"Stock taken by a concurrent reservation | product_id={product_id} | requested={amount}")
+            return {
+                "ok": False,
+                "error": "INSUFFICIENT_STOCK",
+                "message": f"Insufficient stock. Requested: {amount}"
+            }
 
         log_stock_change(product_id, "RESERVE", amount, stock.available_quantity, stock.reserved_quantity)
         logger.info(f"Stock reserved successfully | product_id={product_id} | amount={amount} | available={stock.available_quantity} | reserved={stock.reserved_quantity}")
@@ -181,10 +780,13 @@ def reserve_stock(product_id, amount):
         log_error("reserve_stock", err, {"product_id": product_id, "amount": amount})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
-def unreserve_stock(product_id, amount):
+@traced
+@deadline_bound
+def unreserve_stock(product_id, amount, location=None):
     """
     Release reserved stock back to available.
 
@@ -194,9 +796,17 @@ def unreserve_stock(product_id, amount):
     Args:
         product_id: ID of the product to unreserve
         amount: Quantity to release back to available
+        location: Location returned by reserve_stock, for products split across warehouses
     """
     try:
         logger.info(f"Unreserving stock | product_id={product_id} | amount={amount}")
+        try:
+            engine = _engine_for(product_id, location)
+        except ValueError as err:
+            return _validation_error(str(err))
+        if engine is not None:
+            return engine.execute("unreserve", product_id, amount)
+
         stock = Stock.objects(id=product_id).first()
 
         if not stock:
@@ -214,6 +824,24 @@ def unreserve_stock(product_id, amount):
                 "error": "",
                 "message": "cannot unreserve with 0 or less"
             }
+        if stock.locations or location is not None:
+            updated, location = _release_at_location(stock, amount, location, amount, -amount, "UNRESERVE")
+            if updated is None:
+                logger.warning(f"Cannot unreserve more than reserved at location | product_id={product_id} | location={location} | requested={amount}")
+                return {
+                    "ok": False,
+                    "error": "",
+                    "message": "cannot unreserve more than reserved"
+                }
+            log_stock_change(product_id, "UNRESERVE", amount, updated.available_quantity, updated.reserved_quantity)
+            logger.info(f"Stock unreserved successfully | product_id={product_id} | amount={amount} | location={location} | available={updated.available_quantity} | reserved={updated.reserved_quantity}")
+            return {
+                "ok": True,
+                "message": "Product updated successfully",
+                "product": updated.to_dict(),
+                "location": location
+            }
+
         if stock.reserved_quantity < amount:
             logger.warning(f"Cannot unreserve more than reserved | product_id={product_id} | reserved={stock.reserved_quantity} | requested={amount}")
             return {
@@ -222,9 +850,19 @@ def unreserve_stock(product_id, amount):
                 "message": "cannot unreserve more than reserved"
             }
 
-        stock.available_quantity+=amount
-        stock.reserved_quantity-=amount
-        stock.save()
+        stock = _apply_change(
+            product_id,
+            new_event(EVENT_UPDATED, "UNRESERVE", amount=amount),
+            guard={'reserved_quantity': {'$gte': amount}},
+            inc_fields={'available_quantity': amount, 'reserved_quantity': -amount}
+        )
+        if stock is None:
+            logger.warning(f"Cannot unreserve more than reserved | product_id={product_id} | requested={amount}")
+            return {
+                "ok": False,
+                "error": "",
+                "message": "cannot unreserve more than reserved"
+            }
 
         log_stock_change(product_id, "UNRESERVE", amount, stock.available_quantity, stock.reserved_quantity)
         logger.info(f"Stock unreserved successfully | product_id={product_id} | amount={amount} | available={stock.available_quantity} | reserved={stock.reserved_quantity}")
@@ -238,12 +876,31 @@ def unreserve_stock(product_id, amount):
         log_error("unreserve_stock", err, {"product_id": product_id, "amount": amount})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
+@traced
+@deadline_bound
 def delete_stock(product_id):
-    """Delete a product from stock"""
+    """
+    Delete a product from stock.
+
+    The product is flagged deleted together with its DELETED event and is
+    hidden from every read straight away. The outbox relay removes the
+    document once the event has been published.
+
+    With the inventory engine, deletes go through the stock.delete_stock
+    task so the worker owning the product evicts it from its counters.
+    """
     try:
+        engine = get_engine()
+        if engine is None and engine_enabled():
+            # the worker's engine would keep serving the product from memory
+            return _validation_error(ENGINE_OWNS_DELETES)
+        if engine is not None and engine.partition(str(product_id)) is None:
+            return WRONG_PARTITION_RESULT
+
         stock = Stock.objects(id=product_id).first()
 
         if not stock:
@@ -255,7 +912,18 @@ def delete_stock(product_id):
             }
 
         product_name = stock.product_name
-        stock.delete()
+        deleted = _apply_change(
+            product_id, new_event(EVENT_DELETED, "DELETE"), set_fields={'deleted': True}, engine_counters=engine_enabled()
+        )
+        if deleted is None:
+            return {
+                "ok": False,
+                "error": "NOT_FOUND",
+                "message": "Product not found"
+            }
+        if engine is not None:
+            engine.evict(product_id)
+        suggest_index.remove(product_id)
         logger.info(f"Stock deleted | product_id={product_id} | product_name={product_name}")
         log_db_operation("DELETE", "stocks", product_id)
 
@@ -267,13 +935,16 @@ def delete_stock(product_id):
         log_error("delete_stock", err, {"product_id": product_id})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
 
 
 # Finalizing stock purchases after successful transaction
-def finalise_stock_purchase(product_id, amount):
+@traced
+@deadline_bound
+def finalise_stock_purchase(product_id, amount, location=None):
     """
     Finalize a stock purchase after successful transaction.
 
@@ -284,9 +955,17 @@ def finalise_stock_purchase(product_id, amount):
     Args:
         product_id: ID of the product purchased
         amount: Quantity that was purchased
+        location: Location returned by reserve_stock, for products split across warehouses
     """
     try:
         logger.info(f"Finalizing stock purchase | product_id={product_id} | amount={amount}")
+        try:
+            engine = _engine_for(product_id, location)
+        except ValueError as err:
+            return _validation_error(str(err))
+        if engine is not None:
+            return engine.execute("finalise", product_id, amount)
+
         stock = Stock.objects(id=product_id).first()
 
         if not stock:
@@ -297,15 +976,39 @@ def finalise_stock_purchase(product_id, amount):
                 "message": "Product not found"
             }
 
+        if stock.locations or location is not None:
+            updated, location = _release_at_location(stock, amount, location, 0, -amount, "FINALIZE_PURCHASE")
+            if updated is None:
+                logger.error(f"Finalize amount exceeds reserved at location | product_id={product_id} | location={location} | amount={amount}")
+                return {
+                    "ok": False,
+                    "message": "finalised amount doesn't match reserved stock"
+                }
+            log_stock_change(product_id, "FINALIZE_PURCHASE", amount, updated.available_quantity, updated.reserved_quantity)
+            logger.info(f"Stock purchase finalized | product_id={product_id} | amount={amount} | location={location} | remaining_reserved={updated.reserved_quantity}")
+            return {
+                "ok": True,
+                "message": "Stock purchase finalized successfully"
+            }
+
         if stock.reserved_quantity<amount:
             logger.error(f"Finalize amount exceeds reserved | product_id={product_id} | reserved={stock.reserved_quantity} | amount={amount}")
             return {
                 "ok": False,
                 "message": "finalised amount doesn't match reserved stock"
             }
-        stock.reserved_quantity=stock.reserved_quantity - amount
-
-        stock.save()
+        stock = _apply_change(
+            product_id,
+            new_event(EVENT_UPDATED, "FINALIZE_PURCHASE", amount=amount),
+            guard={'reserved_quantity': {'$gte': amount}},
+            inc_fields={'reserved_quantity': -amount}
+        )
+        if stock is None:
+            logger.error(f"Finalize amount exceeds reserved | product_id={product_id} | amount={amount}")
+            return {
+                "ok": False,
+                "message": "finalised amount doesn't match reserved stock"
+            }
 
         log_stock_change(product_id, "FINALIZE_PURCHASE", amount, stock.available_quantity, stock.reserved_quantity)
         logger.info(f"Stock purchase finalized | product_id={product_id} | amount={amount} | remaining_reserved={stock.reserved_quantity}")
@@ -318,14 +1021,29 @@ def finalise_stock_purchase(product_id, amount):
         log_error("finalise_stock_purchase", err, {"product_id": product_id, "amount": amount})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
 
 
-def add_stock(product_id, amount):
-    """Add stock for a product (used for refunds)"""
+@traced
+@deadline_bound
+def add_stock(product_id, amount, location=None):
+    """
+    Add stock for a product (used for refunds)
+
+    Products split across warehouses need the location to add to, unless
+    they are stocked at a single location.
+    """
     try:
         logger.info(f"Adding stock | product_id={product_id} | amount={amount}")
+        try:
+            engine = _engine_for(product_id, location)
+        except ValueError as err:
+            return _validation_error(str(err))
+        if engine is not None:
+            return engine.execute("add", product_id, amount)
+
         stock = Stock.objects(id=product_id).first()
 
         if not stock:
@@ -344,9 +1062,41 @@ def add_stock(product_id, amount):
                 "message": "cannot add 0 or less stock"
             }
 
+        if stock.locations or location is not None:
+            if location is None and len(stock.locations) == 1:
+                location = next(iter(stock.locations))
+            if location is None:
+                return _validation_error("product is split across locations, a location is required")
+            if location not in (stock.locations or {}):
+                return _validation_error(f"product has no stock at location {location}")
+            updated = _move_location_stock(product_id, location, amount, 0, "ADD_STOCK", amount)
+            if updated is None:
+                return {
+                    "ok": False,
+                    "error": "NOT_FOUND",
+                    "message": "Product not found"
+                }
+            log_stock_change(product_id, "ADD_STOCK", amount, updated.available_quantity, updated.reserved_quantity)
+            logger.info(f"Stock added successfully | product_id={product_id} | amount={amount} | location={location} | available: {stock.available_quantity} -> {updated.available_quantity}")
+            return {
+                "ok": True,
+                "message": "Stock added successfully",
+                "product": updated.to_dict(),
+                "location": location
+            }
+
         old_qty = stock.available_quantity
-        stock.available_quantity+=amount
-        stock.save()
+        stock = _apply_change(
+            product_id,
+            new_event(EVENT_UPDATED, "ADD_STOCK", amount=amount),
+            inc_fields={'available_quantity': amount}
+        )
+        if stock is None:
+            return {
+                "ok": False,
+                "error": "NOT_FOUND",
+                "message": "Product not found"
+            }
 
         log_stock_change(product_id, "ADD_STOCK", amount, stock.available_quantity, stock.reserved_quantity)
         logger.info(f"Stock added successfully | product_id={product_id} | amount={amount} | available: {old_qty} -> {stock.available_quantity}")
@@ -360,5 +1110,6 @@ def add_stock(product_id, amount):
         log_error("add_stock", err, {"product_id": product_id, "amount": amount})
         return {
             "ok": False,
+            "error": error_code(err),
             "message": str(err)
         }
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""
+Autocomplete index over product names
+
+A sorted list of (key, product_id) searched with bisect. Every word of a
+product name contributes one key (the name from that word on, lowercased),
+so "wireless mouse" is found by "wir", "mou" and "wireless m".
+
+The index lives in the process serving HTTP and is updated by the write
+paths running there (create, update, bulk update, delete).
+Reservations happen in the Celery workers and reprices compute quantities
+server side, so the whole index is also rebuilt from Mongo in the
+background every SUGGEST_REFRESH_S seconds to pick up stock level changes. Updates made while a rebuild scans Mongo
+are recorded and replayed on top of the rebuilt index.
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from app.models.stock import Stock
+from app.services.outbox import LIVE
+from app.utils.logging_config import logger, log_error
+
+# entries examined per requested suggestion, bounds the time suggest() holds the lock
+SCAN_FACTOR = 20
+
+
+def _keys(product_name):
+    """Index keys of a product name: the name from each word start on"""
+    name = " ".join(str(product_name).lower().split())
+    keys = {name}
+    for index, char in enumerate(name):
+        if char == " ":
+            keys.add(name[index + 1:])
+    return keys
+
+
+class SuggestIndex:
+    """Prefix index of product names with their availability"""
+
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self._entries = []        # sorted (key, product_id)
+        self._products = {}       # product_id -> (product_name, available_quantity)
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._refreshing = False
+        # changes made while build() scans Mongo, None when no build is running
+        self._pending = None
+
+    def __len__(self):
+        return len(self._products)
+
+    def build(self):
+        """Load every product name and quantity from Mongo and swap the index in"""
+        with self._lock:
+            self._pending = []
+        products = {}
+        entries = []
+        try:
+            cursor = Stock._get_collection().find(LIVE, {"product_name": 1, "available_quantity": 1})
+            for doc in cursor:
+                product_id = str(doc["_id"])
+                products[product_id] = (doc.get("product_name", ""), doc.get("available_quantity", 0))
+                entries.extend((key, product_id) for key in _keys(doc.get("product_name", "")))
+            entries.sort()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._entries = entries
+            self._products = products
+            # the scan may have read some documents before these changes
+            for change, args in pending:
+                change(*args)
+            self._built_at = time.monotonic()
+        logger.info(f"Suggest index built | products={len(products)} | keys={len(entries)}")
+
+    def upsert(self, product_id, product_name, available_quantity):
+        product_id = str(product_id)
+        with self._lock:
+            self._upsert(product_id, product_name, available_quantity)
+            if self._pending is not None:
+                self._pending.append((self._upsert, (product_id, product_name, available_quantity)))
+
+    def set_quantity(self, product_id, available_quantity):
+        """Update the availability of a product already in the index"""
+        product_id = str(product_id)
+        with self._lock:
+            self._set_quantity(product_id, available_quantity)
+            if self._pending is not None:
+                self._pending.append((self._set_quantity, (product_id, available_quantity)))
+
+    def remove(self, product_id):
+        product_id = str(product_id)
+        with self._lock:
+            self._remove(product_id)
+            if self._pending is not None:
+                self._pending.append((self._remove, (product_id,)))
+
+    # callers hold the lock
+
+    def _upsert(self, product_id, product_name, available_quantity):
+        old = self._products.get(product_id)
+        if old is not None and old[0] != product_name:
+            self._remove_keys(product_id, old[0])
+        if old is None or old[0] != product_name:
+            for key in _keys(product_name):
+                insort(self._entries, (key, product_id))
+        self._products[product_id] = (product_name, available_quantity)
+
+    def _set_quantity(self, product_id, available_quantity):
+        old = self._products.get(product_id)
+        if old is not None:
+            self._products[product_id] = (old[0], available_quantity)
+
+    def _remove(self, product_id):
+        old = self._products.pop(product_id, None)
+        if old is not None:
+            self._remove_keys(product_id, old[0])
+
+    def _remove_keys(self, product_id, product_name):
+        for key in _keys(product_name):
+            index = bisect_left(self._entries, (key, product_id))
+            if index < len(self._entries) and self._entries[index] == (key, product_id):
+                del self._entries[index]
+
+    def suggest(self, prefix, limit=10, in_stock_only=True):
+        """
+        Return up to limit products whose name (or a word of it) starts with prefix.
+
+        Results are in alphabetical order of the matching key. At most
+        limit * SCAN_FACTOR entries are examined, so a short prefix over
+        mostly out of stock products can return fewer than limit.
+        """
+        self._maybe_refresh()
+        prefix = " ".join(str(prefix).lower().split())
+        if not prefix or limit <= 0:
+            return []
+
+        results = []
+        seen = set()
+        with self._lock:
+            index = bisect_left(self._entries, (prefix,))
+            end = min(len(self._entries), index + limit * SCAN_FACTOR)
+            while index < end and len(results) < limit:
+                key, product_id = self._entries[index]
+                index += 1
+                if not key.startswith(prefix):
+                    break
+                if product_id in seen:
+                    continue
+                product_name, available = self._products[product_id]
+                if in_stock_only and available <= 0:
+                    continue
+                seen.add(product_id)
+                results.append({
+                    "product_id": product_id,
+                    "product_name": product_name,
+                    "available_quantity": available
+                })
+        return results
+
+    def _maybe_refresh(self):
+        if self._refreshing or not self.refresh_seconds:
+            return
+        if self._built_at is not None and time.monotonic() - self._built_at < self.refresh_seconds:
+            return
+        self._refreshing = True
+        threading.Thread(target=self._refresh, name="suggest-index-refresh", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.build()
+        except Exception as err:
+            log_error("suggest_index.refresh", err)
+            # keep serving the old index and retry after another interval
+            self._built_at = time.monotonic()
+        finally:
+            self._refreshing = False
+
+
+suggest_index = SuggestIndex()
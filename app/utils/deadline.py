@@ -0,0 +1,155 @@
+"""
+Request deadline propagation
+
+The deadline for the current HTTP request or Celery task is kept in a
+context variable so it follows every stock_service call without changing
+their signatures. Service functions wrapped with deadline_bound are skipped
+once the deadline has passed, and otherwise run inside pymongo.timeout(),
+which sends the remaining budget as maxTimeMS on every Mongo command.
+"""
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from typing import Optional
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from app.utils.logging_config import logger
+
+TIMEOUT_ERROR = "TIMEOUT"
+
+# absolute deadline on the time.monotonic() clock, None means no deadline
+_deadline: ContextVar[Optional[float]] = ContextVar("stock_deadline", default=None)
+
+
+def set_deadline(deadline: Optional[float]):
+    """Set the monotonic deadline for the current context, returns a reset token"""
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token) -> None:
+    """Restore the deadline that was active before set_deadline"""
+    _deadline.reset(token)
+
+
+def get_deadline() -> Optional[float]:
+    return _deadline.get()
+
+
+def deadline_from_timeout(seconds: Optional[float]) -> Optional[float]:
+    """Turn a relative budget in seconds into a monotonic deadline"""
+    if seconds is None:
+        return None
+    return time.monotonic() + seconds
+
+
+def deadline_from_timestamp(timestamp: Optional[float]) -> Optional[float]:
+    """Turn a wall clock epoch timestamp into a monotonic deadline"""
+    if timestamp is None:
+        return None
+    return time.monotonic() + (timestamp - time.time())
+
+
+def earliest(*deadlines: Optional[float]) -> Optional[float]:
+    """Return the earliest of several optional deadlines"""
+    known = [deadline for deadline in deadlines if deadline is not None]
+    return min(known) if known else None
+
+
+def remaining_seconds() -> Optional[float]:
+    """Seconds left before the current deadline, None if there is none"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def deadline_exceeded() -> bool:
+    remaining = remaining_seconds()
+    return remaining is not None and remaining <= 0
+
+
+def http_deadline(headers, default_timeout_ms: int = 0) -> Optional[float]:
+    """
+    Read the deadline of an incoming HTTP request.
+
+    Args:
+        headers: Request headers
+        default_timeout_ms: Budget used when the caller sends none (0 = no deadline)
+
+    Supported headers:
+        X-Request-Deadline: absolute epoch seconds
+        X-Request-Timeout-Ms: relative budget in milliseconds
+    """
+    deadline = None
+    try:
+        if headers.get("X-Request-Deadline"):
+            deadline = deadline_from_timestamp(float(headers["X-Request-Deadline"]))
+        if headers.get("X-Request-Timeout-Ms"):
+            deadline = earliest(deadline, deadline_from_timeout(float(headers["X-Request-Timeout-Ms"]) / 1000))
+    except ValueError:
+        logger.warning(f"Ignoring malformed deadline headers | deadline={headers.get('X-Request-Deadline')} | timeout_ms={headers.get('X-Request-Timeout-Ms')}")
+    if deadline is None and default_timeout_ms:
+        deadline = deadline_from_timeout(default_timeout_ms / 1000)
+    return deadline
+
+
+def task_deadline(expires=None, timelimit=None) -> Optional[float]:
+    """
+    Read the deadline of a Celery task from its request.
+
+    Args:
+        expires: task.request.expires (datetime or ISO 8601 string)
+        timelimit: task.request.timelimit, a (hard, soft) tuple of seconds
+    """
+    deadline = None
+    if expires:
+        if isinstance(expires, str):
+            expires = datetime.fromisoformat(expires)
+        deadline = deadline_from_timestamp(expires.timestamp())
+    for limit in timelimit or ():
+        if limit:
+            deadline = earliest(deadline, deadline_from_timeout(limit))
+    return deadline
+
+
+def is_timeout(err: Exception) -> bool:
+    """
+    True for pymongo errors caused by maxTimeMS or socket timeouts.
+
+    Follows the exception chain, since mongoengine re-raises pymongo
+    errors from save() / delete() as OperationError.
+    """
+    seen = set()
+    while err is not None and id(err) not in seen:
+        if isinstance(err, PyMongoError) and err.timeout:
+            return True
+        seen.add(id(err))
+        err = err.__cause__ or err.__context__
+    return False
+
+
+def error_code(err: Exception) -> str:
+    """Error code for unexpected exceptions caught in the service layer"""
+    return TIMEOUT_ERROR if is_timeout(err) else ""
+
+
+def deadline_bound(f):
+    """Decorator for service functions that should respect the current deadline"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        remaining = remaining_seconds()
+        if remaining is None:
+            return f(*args, **kwargs)
+        if remaining <= 0:
+            logger.warning(f"Deadline exceeded, skipping | {f.__name__} | overdue_ms={int(-remaining * 1000)}")
+            return {
+                "ok": False,
+                "error": TIMEOUT_ERROR,
+                "message": "Deadline exceeded before the operation started"
+            }
+        with pymongo.timeout(remaining):
+            return f(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,89 @@
+"""
+Product partitioning helpers
+"""
+import zlib
+
+
+def partition_for(product_id, partitions: int) -> int:
+    """
+    Map a product id to a partition.
+
+    Uses crc32 rather than hash() so every process (Flask, Celery producers
+    and workers) agrees on the partition regardless of PYTHONHASHSEED.
+    """
+    if partitions <= 1:
+        return 0
+    return zlib.crc32(str(product_id).encode()) % partitions
+
+
+STOCK_QUEUE = "stock_queue"
+
+# tasks that act on a single product and are routed to its partition
+PARTITIONED_STOCK_TASKS = {
+    "stock.reserve_stock",
+    "stock.unreserve_stock",
+    "stock.finalise_stock_purchase",
+    "stock.add_stock",
+    "stock.delete_stock",
+}
+
+
+def stock_queue_for(product_id, partitions: int) -> str:
+    """Queue for a product: stock_queue.<k>, or the single stock_queue when partitioning is off"""
+    if partitions <= 0:
+        return STOCK_QUEUE
+    return f"{STOCK_QUEUE}.{partition_for(product_id, partitions)}"
+
+
+def stock_queues(partitions: int) -> list:
+    """Every queue stock tasks can be routed to"""
+    return [STOCK_QUEUE] + [f"{STOCK_QUEUE}.{index}" for index in range(max(partitions, 0))]
+
+
+def stock_task_router(partitions: int):
+    """
+    Celery router sending stock.* tasks to the partition of their product.
+
+    Producers (e.g. the cart service) must install the same router with the
+    same partition count:
+
+        celery.conf.task_routes = (stock_task_router(8), {...})
+
+    Other stock tasks (stock.get_many, stock.export_snapshot) stay on stock_queue.
+    """
+    def route(name, args, kwargs, options, task=None, **kw):
+        if not name.startswith("stock."):
+            return None
+        if name not in PARTITIONED_STOCK_TASKS:
+            return {"queue": STOCK_QUEUE}
+        product_id = (kwargs or {}).get("product_id")
+        if product_id is None and args:
+            product_id = args[0]
+        if not isinstance(product_id, str):
+            return {"queue": STOCK_QUEUE}
+        return {"queue": stock_queue_for(product_id, partitions)}
+    return route
+
+
+def parse_partitions(raw, partitions: int) -> list:
+    """
+    Parse a partition list such as "0,2,5" or "0-3".
+
+    Returns every partition when raw is empty.
+    """
+    if not raw:
+        return list(range(partitions))
+    owned = set()
+    for entry in str(raw).split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if "-" in entry:
+            start, end = entry.split("-", 1)
+            owned.update(range(int(start), int(end) + 1))
+        else:
+            owned.add(int(entry))
+    invalid = [index for index in owned if not 0 <= index < partitions]
+    if invalid:
+        raise ValueError(f"Partitions {sorted(invalid)} out of range for {partitions} partitions")
+    return sorted(owned)
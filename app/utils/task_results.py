@@ -0,0 +1,63 @@
+"""
+Result shaping for Celery tasks
+"""
+from typing import Optional
+
+# Result policies:
+#   full    -> store the whole service result (including the product dict)
+#   compact -> store only ok / error / message
+#   ignore  -> nothing is written to the result backend
+RESULT_POLICY_FULL = "full"
+RESULT_POLICY_COMPACT = "compact"
+RESULT_POLICY_IGNORE = "ignore"
+
+RESULT_POLICIES = (RESULT_POLICY_FULL, RESULT_POLICY_COMPACT, RESULT_POLICY_IGNORE)
+
+
+def validate_result_policy(policy: str, source: str = "CELERY_RESULT_POLICY") -> str:
+    """Return policy, raising ValueError when it isn't a known result policy"""
+    policy = (policy or "").strip()
+    if policy not in RESULT_POLICIES:
+        raise ValueError(f"Unknown result policy '{policy}' in {source}, expected one of {', '.join(RESULT_POLICIES)}")
+    return policy
+
+
+def parse_result_policies(raw: Optional[str]) -> dict:
+    """
+    Parse a per-task policy string into a dict.
+
+    Args:
+        raw: e.g. "stock.reserve_stock=compact,stock.add_stock=ignore"
+
+    Returns:
+        Mapping of task name to policy
+    """
+    policies = {}
+    for entry in (raw or "").split(","):
+        if "=" not in entry:
+            continue
+        task_name, policy = entry.split("=", 1)
+        policies[task_name.strip()] = validate_result_policy(policy, f"CELERY_RESULT_POLICIES for task '{task_name.strip()}'")
+    return policies
+
+
+def compact_result(result: dict) -> dict:
+    """Keep only the status of a service result"""
+    compact = {"ok": result.get("ok")}
+    if "location" in result:
+        compact["location"] = result["location"]
+    if not result.get("ok"):
+        compact["error"] = result.get("error", "")
+        compact["message"] = result.get("message")
+    return compact
+
+
+def shape_result(policy: str, result: dict) -> Optional[dict]:
+    """Trim a service result according to a result policy"""
+    if policy == RESULT_POLICY_FULL:
+        return result
+    if policy == RESULT_POLICY_IGNORE:
+        return None
+    if policy == RESULT_POLICY_COMPACT:
+        return compact_result(result)
+    raise ValueError(f"Unknown result policy '{policy}'")
@@ -0,0 +1,295 @@
+"""
+Lightweight request tracing
+
+Spans are created for Flask requests, Celery tasks, stock_service calls and
+every Mongo command, and share a trace id carried in W3C traceparent
+headers (HTTP and Celery message headers).
+
+Sampling is decided once per trace at the root span (TRACE_SAMPLE_RATE).
+Unsampled traces still propagate their ids but record nothing, so the cost
+per request is a couple of context variable lookups.
+
+Finished spans go to a pluggable exporter:
+    none   -> dropped (default)
+    memory -> kept in InMemoryExporter.spans, for tests
+    file   -> appended as JSON lines to TRACE_FILE, flushed in batches
+"""
+import atexit
+import json
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+
+from pymongo import monitoring
+
+from app.utils.logging_config import logger
+
+TRACEPARENT_HEADER = "traceparent"
+SENT_AT_HEADER = "x-trace-sent-at"
+
+
+class Span:
+    """A timed operation within a trace"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "sampled", "start", "end", "attributes", "status")
+
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes or {}
+        self.status = "OK"
+
+    def set_attribute(self, key, value):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def set_error(self, message):
+        if self.sampled:
+            self.status = "ERROR"
+            self.attributes["error"] = message
+
+    def finish(self):
+        self.end = time.time()
+        if self.sampled:
+            _exporter.export(self)
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) * 1000, 3) if self.end else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+# exporters
+
+class NullExporter:
+    def export(self, span):
+        pass
+
+    def flush(self):
+        pass
+
+
+class InMemoryExporter:
+    """Keeps finished spans in a list, for tests"""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class FileExporter:
+    """Appends spans as JSON lines, writing once every batch_size spans"""
+
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._buffer.append(span.to_dict())
+            if len(self._buffer) < self.batch_size:
+                return
+            buffer, self._buffer = self._buffer, []
+        self._write(buffer)
+
+    def flush(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+        if buffer:
+            self._write(buffer)
+
+    def _write(self, spans):
+        try:
+            with open(self.path, "a", encoding="utf-8") as out:
+                out.write("".join(json.dumps(span) + "\n" for span in spans))
+        except OSError as err:
+            logger.warning(f"Could not write trace spans | path={self.path} | error={err}")
+
+
+_exporter = NullExporter()
+_sample_rate = 0.0
+_current_span: ContextVar[Optional[Span]] = ContextVar("stock_trace_span", default=None)
+
+
+def _new_id(size):
+    return os.urandom(size).hex()
+
+
+def set_exporter(exporter, sample_rate=1.0):
+    """Install an exporter and sampling rate for this process"""
+    global _exporter, _sample_rate
+    _exporter = exporter
+    _sample_rate = sample_rate
+
+
+def get_exporter():
+    return _exporter
+
+
+def configure_tracing():
+    """
+    Set up tracing from the environment and register the Mongo listener.
+
+    Must run before the Mongo connection is created.
+    """
+    kind = os.getenv("TRACE_EXPORTER", "none")
+    sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+    if kind == "file":
+        exporter = FileExporter(os.getenv("TRACE_FILE", "traces.jsonl"), int(os.getenv("TRACE_BATCH_SIZE", 100)))
+    elif kind == "memory":
+        exporter = InMemoryExporter()
+    else:
+        exporter = NullExporter()
+        sample_rate = 0.0
+    set_exporter(exporter, sample_rate)
+    atexit.register(exporter.flush)
+    _register_mongo_listener()
+    logger.info(f"Tracing configured | exporter={kind} | sample_rate={sample_rate}")
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def parse_traceparent(header):
+    """Return (trace_id, parent_id, sampled) from a traceparent header, None if malformed"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == "01"
+
+
+def start_span(name, traceparent=None, attributes=None):
+    """
+    Start a span and make it current. Pair with end_span(span, token).
+
+    The parent is the current span, else the traceparent header, else a new
+    trace is started and the sampling decision made.
+    """
+    parent = _current_span.get()
+    if parent is not None:
+        span = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes if parent.sampled else None)
+    else:
+        remote = parse_traceparent(traceparent)
+        if remote is not None:
+            trace_id, parent_id, sampled = remote
+            sampled = sampled and _sample_rate > 0
+        else:
+            trace_id, parent_id = _new_id(16), None
+            sampled = _sample_rate > 0 and random.random() < _sample_rate
+        span = Span(name, trace_id, parent_id, sampled, attributes if sampled else None)
+    return span, _current_span.set(span)
+
+
+def end_span(span, token):
+    _current_span.reset(token)
+    span.finish()
+
+
+def traced(f):
+    """Decorator wrapping a function call in a span named after it"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        parent = _current_span.get()
+        if (parent is None and _sample_rate <= 0) or (parent is not None and not parent.sampled):
+            return f(*args, **kwargs)
+        span, token = start_span(f"stock_service.{f.__name__}")
+        try:
+            result = f(*args, **kwargs)
+            if isinstance(result, dict) and not result.get("ok", True):
+                span.set_attribute("error_code", result.get("error", ""))
+            return result
+        except Exception as err:
+            span.set_error(f"{type(err).__name__}: {err}")
+            raise
+        finally:
+            end_span(span, token)
+    return wrapper
+
+
+def inject_headers(headers):
+    """Add the current trace context to outgoing Celery message headers"""
+    span = _current_span.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = span.traceparent
+    headers[SENT_AT_HEADER] = time.time()
+
+
+# Mongo commands
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Records a child span for every Mongo command issued inside a sampled span"""
+
+    def __init__(self):
+        self._spans = {}
+
+    def started(self, event):
+        try:
+            parent = _current_span.get()
+            if parent is None or not parent.sampled:
+                return
+            target = event.command.get(event.command_name)
+            span = Span(f"mongo.{event.command_name}", parent.trace_id, parent.span_id, True, {
+                "db": event.database_name,
+                "collection": target if isinstance(target, str) else None,
+            })
+            self._spans[(event.connection_id, event.request_id)] = span
+        except Exception:
+            pass
+
+    def succeeded(self, event):
+        span = self._spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.set_attribute("duration_us", event.duration_micros)
+            span.finish()
+
+    def failed(self, event):
+        span = self._spans.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.set_error(str(event.failure.get("errmsg", event.failure)) if isinstance(event.failure, dict) else str(event.failure))
+            span.finish()
+
+
+_mongo_listener = None
+
+
+def _register_mongo_listener():
+    global _mongo_listener
+    if _mongo_listener is None:
+        _mongo_listener = MongoCommandTracer()
+        monitoring.register(_mongo_listener)
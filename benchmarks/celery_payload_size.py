@@ -0,0 +1,85 @@
+"""
+Broker and result backend bytes per stock reservation
+
+Serializes a stock.reserve_stock message and its stored result with each
+serializer / result policy combination and prints the encoded sizes.
+Broker bytes are the whole message as the Redis transport stores it:
+protocol 2 headers and properties plus the base64 encoded body.
+No Redis or MongoDB connection is needed.
+
+Usage:
+    python -m benchmarks.celery_payload_size
+"""
+import json
+import uuid
+from datetime import datetime, timezone
+
+from celery import Celery
+from kombu import Connection
+from kombu.serialization import dumps
+
+from app.utils.task_results import RESULT_POLICIES, RESULT_POLICY_IGNORE, shape_result
+
+SERIALIZERS = ["json", "msgpack"]
+
+
+def sample_result():
+    """A successful reserve_stock service result"""
+    return {
+        "ok": True,
+        "message": "Product updated successfully",
+        "product": {
+            "product_id": "65a1f0c2e4b0a1b2c3d4e5f6",
+            "product_name": "Mechanical Keyboard",
+            "available_quantity": 118,
+            "reserved_quantity": 2,
+            "price": 89.99,
+        },
+    }
+
+
+def broker_message_size(serializer):
+    """Bytes of a stock.reserve_stock message in Redis, built the way Celery and kombu build it"""
+    app = Celery("benchmark", broker="memory://", set_as_current=False)
+    message = app.amqp.as_task_v2(str(uuid.uuid4()), "stock.reserve_stock", args=["65a1f0c2e4b0a1b2c3d4e5f6", 2], kwargs={})
+    content_type, content_encoding, body = dumps(message.body, serializer=serializer)
+    with Connection("memory://") as conn:
+        channel = conn.default_channel
+        envelope = channel.prepare_message(body, 0, content_type, content_encoding, message.headers, message.properties)
+        # the Redis transport base64 encodes bodies and stores the envelope as JSON
+        envelope["body"], envelope["properties"]["body_encoding"] = channel.encode_body(envelope["body"], "base64")
+    return len(json.dumps(envelope))
+
+
+def backend_meta(result):
+    """Document the Redis result backend stores under celery-task-meta-<id>"""
+    return {
+        "status": "SUCCESS",
+        "result": result,
+        "traceback": None,
+        "children": [],
+        "date_done": datetime.now(timezone.utc).isoformat(),
+        "task_id": str(uuid.uuid4()),
+    }
+
+
+def encoded_size(payload, serializer):
+    _, _, data = dumps(payload, serializer=serializer)
+    return len(data)
+
+
+def main():
+    print(f"{'serializer':<10} | {'policy':<8} | {'broker bytes':>12} | {'backend bytes':>13} | {'total':>6}")
+    for serializer in SERIALIZERS:
+        broker_bytes = broker_message_size(serializer)
+        for policy in RESULT_POLICIES:
+            if policy == RESULT_POLICY_IGNORE:
+                backend_bytes = 0
+            else:
+                backend_bytes = encoded_size(backend_meta(shape_result(policy, sample_result())), serializer)
+            total = broker_bytes + backend_bytes
+            print(f"{serializer:<10} | {policy:<8} | {broker_bytes:>12} | {backend_bytes:>13} | {total:>6}")
+
+
+if __name__ == "__main__":
+    main()
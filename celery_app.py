@@ -1,8 +1,15 @@
 from celery import Celery
+from celery.signals import task_prerun, task_postrun, worker_init, worker_shutdown, before_task_publish
 from mongoengine import connect
 import os
+import time
 import logging
 from dotenv import load_dotenv
+from app.utils.partitioning import stock_task_router
+from app.services.inventory_engine import engine_enabled
+from app.utils.deadline import task_deadline, set_deadline, reset_deadline
+from app.utils.tracing import configure_tracing, start_span, end_span, inject_headers, get_exporter, TRACEPARENT_HEADER, SENT_AT_HEADER
+from app.utils.task_results import RESULT_POLICY_FULL, RESULT_POLICY_IGNORE, parse_result_policies, shape_result, validate_result_policy
 load_dotenv()
 
 # Set up logging for Celery worker
@@ -19,13 +26,138 @@ celery = Celery(
     backend=f"redis://{os.getenv('CELERY_BROKER_HOST', 'localhost')}:{os.getenv('CELERY_BROKER_PORT', 6379)}/0",
     # include=['stock.unreserve_stock','stock.reserve_stock', 'stock.finalise_stock_purchase','transaction.create','cart.completeCheckout','cart.unfreeze'],
 )
-celery.conf.task_routes = {
-    'transaction.*': {'queue': 'transaction_queue'},
-    'cart.*': {'queue': 'cart_queue'},
-    'stock.*': {'queue': 'stock_queue'},
-}
+# STOCK_QUEUE_PARTITIONS > 0 routes stock tasks to stock_queue.<k> by product_id
+STOCK_QUEUE_PARTITIONS = int(os.getenv('STOCK_QUEUE_PARTITIONS', 0))
+celery.conf.task_routes = (
+    stock_task_router(STOCK_QUEUE_PARTITIONS),
+    {
+        'transaction.*': {'queue': 'transaction_queue'},
+        'cart.*': {'queue': 'cart_queue'},
+        'stock.*': {'queue': 'stock_queue'},
+    },
+)
+
+# Serialization and result backend settings
+# msgpack is always accepted so workers and producers can be switched over one at a time
+CELERY_SERIALIZER = os.getenv('CELERY_SERIALIZER', 'json')
+celery.conf.task_serializer = CELERY_SERIALIZER
+celery.conf.result_serializer = CELERY_SERIALIZER
+celery.conf.accept_content = ['json', 'msgpack']
+celery.conf.result_accept_content = ['json', 'msgpack']
+celery.conf.result_expires = int(os.getenv('CELERY_RESULT_EXPIRES', 3600))
 celery.autodiscover_tasks()
 
+# Periodic analytics snapshots (run celery beat alongside the worker)
+SNAPSHOT_INTERVAL_S = int(os.getenv('SNAPSHOT_INTERVAL_S', 0))
+if SNAPSHOT_INTERVAL_S:
+    celery.conf.beat_schedule = {
+        'stock-incremental-snapshot': {
+            'task': 'stock.export_snapshot',
+            'schedule': SNAPSHOT_INTERVAL_S,
+            'kwargs': {'mode': 'incremental'},
+        },
+    }
+
+DEFAULT_RESULT_POLICY = validate_result_policy(os.getenv('CELERY_RESULT_POLICY', RESULT_POLICY_FULL))
+TASK_RESULT_POLICIES = parse_result_policies(os.getenv('CELERY_RESULT_POLICIES'))
+
+
+def result_policy(task_name):
+    """Return the result policy configured for a task"""
+    return TASK_RESULT_POLICIES.get(task_name, DEFAULT_RESULT_POLICY)
+
+
+# Deadline propagation: a task's expires / time_limit bounds every stock_service call it makes
+_task_deadline_tokens = {}
+
+
+@task_prerun.connect
+def start_task_deadline(task_id=None, task=None, **kwargs):
+    deadline = task_deadline(task.request.expires, task.request.timelimit)
+    _task_deadline_tokens[task_id] = set_deadline(deadline)
+
+
+@task_postrun.connect
+def clear_task_deadline(task_id=None, **kwargs):
+    token = _task_deadline_tokens.pop(task_id, None)
+    if token is not None:
+        reset_deadline(token)
+
+
+# Optional in-memory inventory engine (INVENTORY_ENGINE=memory)
+# Needs --pool=threads or --pool=solo: every task thread shares this process's engine
+@worker_init.connect
+def start_inventory_engine(sender=None, **kwargs):
+    if not engine_enabled():
+        return
+    pool = getattr(sender, 'pool_cls', '')
+    pool_name = pool if isinstance(pool, str) else getattr(pool, '__module__', '')
+    if 'prefork' in pool_name:
+        raise RuntimeError("INVENTORY_ENGINE=memory requires --pool=threads or --pool=solo")
+
+    from app.services.inventory_engine import start_engine
+    from app.utils.partitioning import parse_partitions
+    partitions = int(os.getenv('ENGINE_PARTITIONS', 1))
+    start_engine(
+        partitions=partitions,
+        owned=parse_partitions(os.getenv('ENGINE_OWNED_PARTITIONS'), partitions),
+        wal_dir=os.getenv('ENGINE_WAL_DIR', 'wal'),
+        group_commit_ms=float(os.getenv('ENGINE_GROUP_COMMIT_MS', 0)),
+        group_commit_size=int(os.getenv('ENGINE_GROUP_COMMIT_SIZE', 512))
+    )
+
+
+@worker_shutdown.connect
+def stop_inventory_engine(**kwargs):
+    from app.services.inventory_engine import stop_engine
+    stop_engine()
+
+
+# Tracing: task spans continue the producer's trace from the message headers
+_task_spans = {}
+
+
+def _request_header(request, name):
+    value = getattr(request, name, None)
+    if value is None:
+        value = (getattr(request, 'headers', None) or {}).get(name)
+    return value
+
+
+@before_task_publish.connect
+def add_trace_headers(headers=None, **kwargs):
+    if headers is not None:
+        inject_headers(headers)
+
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    span, token = start_span(
+        f"celery {task.name}",
+        traceparent=_request_header(task.request, TRACEPARENT_HEADER),
+        attributes={"celery.task_id": task_id, "celery.queue": (task.request.delivery_info or {}).get('routing_key')}
+    )
+    sent_at = _request_header(task.request, SENT_AT_HEADER)
+    if sent_at:
+        span.set_attribute("celery.queue_wait_ms", round((time.time() - float(sent_at)) * 1000, 3))
+    _task_spans[task_id] = (span, token)
+
+
+@task_postrun.connect
+def end_task_span(task_id=None, state=None, **kwargs):
+    span, token = _task_spans.pop(task_id, (None, None))
+    if span is not None:
+        span.set_attribute("celery.state", state)
+        end_span(span, token)
+
+
+@worker_shutdown.connect
+def flush_traces(**kwargs):
+    get_exporter().flush()
+
+
+# registers the Mongo command listener, must run before connect()
+configure_tracing()
 
 # Initialize MongoDB connection
 connect(
@@ -38,69 +170,136 @@ connect(
 )
 logger.info(f"Stock Celery worker connected to MongoDB")
 
+
+@worker_init.connect
+def upgrade_stock_schema(**kwargs):
+    from app.models import upgrade_stock_collection
+    upgrade_stock_collection()
+
 from app.services.stock_service import reserve_stock
-@celery.task(name="stock.reserve_stock")
-def reserve_stock_task(product_id, amount):
+@celery.task(name="stock.reserve_stock", ignore_result=result_policy("stock.reserve_stock") == RESULT_POLICY_IGNORE)
+def reserve_stock_task(product_id, amount, strategy="most_stocked", near=None, location=None):
     """
     Reserve stock for a product during checkout.
 
     Called by cart service when checkout is initiated.
+    For products split across warehouses the result's location must be sent
+    back with unreserve / finalise.
     """
     logger.info(f"TASK RECEIVED | stock.reserve_stock | product_id={product_id} | amount={amount}")
 
-    result = reserve_stock(product_id, amount)
+    result = reserve_stock(product_id, amount, strategy=strategy, near=near, location=location)
     if result.get("ok"):
         logger.info(f"TASK SUCCESS | stock.reserve_stock | product_id={product_id} | amount={amount}")
     else:
         logger.error(f"TASK FAILED | stock.reserve_stock | product_id={product_id} | error={result.get('message')}")
-    return result
+    return shape_result(result_policy("stock.reserve_stock"), result)
 
 
 from app.services.stock_service import unreserve_stock
-@celery.task(name="stock.unreserve_stock")
-def unreserve_stock_task(product_id, amount):
+@celery.task(name="stock.unreserve_stock", ignore_result=result_policy("stock.unreserve_stock") == RESULT_POLICY_IGNORE)
+def unreserve_stock_task(product_id, amount, location=None):
     """
     Unreserve stock for a product.
 
     Called by cart service if transaction fails and stock needs to be restored.
     """
     logger.info(f"TASK RECEIVED | stock.unreserve_stock | product_id={product_id} | amount={amount}")
-    result = unreserve_stock(product_id, amount)
+    result = unreserve_stock(product_id, amount, location=location)
     if result.get("ok"):
         logger.info(f"TASK SUCCESS | stock.unreserve_stock | product_id={product_id} | amount={amount}")
     else:
         logger.error(f"TASK FAILED | stock.unreserve_stock | product_id={product_id} | error={result.get('message')}")
-    return result
+    return shape_result(result_policy("stock.unreserve_stock"), result)
 
 
 from app.services.stock_service import finalise_stock_purchase
-@celery.task(name="stock.finalise_stock_purchase")
-def finalise_stock_purchase_task(product_id, amount):
+@celery.task(name="stock.finalise_stock_purchase", ignore_result=result_policy("stock.finalise_stock_purchase") == RESULT_POLICY_IGNORE)
+def finalise_stock_purchase_task(product_id, amount, location=None):
     """
     Finalize a stock purchase after successful transaction.
 
     Called by cart service when transaction is completed.
     """
     logger.info(f"TASK RECEIVED | stock.finalise_stock_purchase | product_id={product_id} | amount={amount}")
-    result = finalise_stock_purchase(product_id, amount)
+    result = finalise_stock_purchase(product_id, amount, location=location)
     if result.get("ok"):
         logger.info(f"TASK SUCCESS | stock.finalise_stock_purchase | product_id={product_id} | amount={amount}")
     else:
         logger.error(f"TASK FAILED | stock.finalise_stock_purchase | product_id={product_id} | error={result.get('message')}")
-    return result
+    return shape_result(result_policy("stock.finalise_stock_purchase"), result)
 
 from app.services.stock_service import add_stock
-@celery.task(name="stock.add_stock")
-def add_stock_task(product_id, amount):
+@celery.task(name="stock.add_stock", ignore_result=result_policy("stock.add_stock") == RESULT_POLICY_IGNORE)
+def add_stock_task(product_id, amount, location=None):
     """
     Add stock for a product.
 
     Called by cart service when a refund is processed.
     """
     logger.info(f"TASK RECEIVED | stock.add_stock | product_id={product_id} | amount={amount}")
-    result = add_stock(product_id, amount)
+    result = add_stock(product_id, amount, location=location)
     if result.get("ok"):
         logger.info(f"TASK SUCCESS | stock.add_stock | product_id={product_id} | amount={amount}")
     else:
         logger.error(f"TASK FAILED | stock.add_stock | product_id={product_id} | error={result.get('message')}")
-    return result
\ No newline at end of file
+    return shape_result(result_policy("stock.add_stock"), result)
+
+
+from app.services.stock_service import delete_stock
+@celery.task(name="stock.delete_stock", ignore_result=result_policy("stock.delete_stock") == RESULT_POLICY_IGNORE)
+def delete_stock_task(product_id):
+    """
+    Delete a product.
+
+    Routed to the product's partition, so with the inventory engine the
+    worker holding the product's counters evicts it.
+    """
+    logger.info(f"TASK RECEIVED | stock.delete_stock | product_id={product_id}")
+    result = delete_stock(product_id)
+    if result.get("ok"):
+        logger.info(f"TASK SUCCESS | stock.delete_stock | product_id={product_id}")
+    else:
+        logger.error(f"TASK FAILED | stock.delete_stock | product_id={product_id} | error={result.get('message')}")
+    return shape_result(result_policy("stock.delete_stock"), result)
+
+
+from app.services.stock_service import get_stocks_by_ids
+@celery.task(name="stock.get_many")
+def get_many_task(product_ids):
+    """
+    Look up several products in one query.
+
+    Called by cart service to price and validate a whole cart at once.
+    The result is the whole point of this task, so result policies don't apply.
+    """
+    logger.info(f"TASK RECEIVED | stock.get_many | count={len(product_ids)}")
+    result = get_stocks_by_ids(product_ids)
+    if result.get("ok"):
+        logger.info(f"TASK SUCCESS | stock.get_many | found={len(result['products'])} | not_found={len(result['not_found'])}")
+    else:
+        logger.error(f"TASK FAILED | stock.get_many | error={result.get('message')}")
+    return result
+
+
+from app.services.snapshot_service import export_snapshot
+@celery.task(name="stock.export_snapshot", ignore_result=result_policy("stock.export_snapshot") == RESULT_POLICY_IGNORE)
+def export_snapshot_task(mode="incremental"):
+    """
+    Export the Stock collection to a columnar snapshot file.
+
+    Scheduled by celery beat every SNAPSHOT_INTERVAL_S seconds.
+    """
+    logger.info(f"TASK RECEIVED | stock.export_snapshot | mode={mode}")
+    result = export_snapshot(
+        os.getenv('SNAPSHOT_DIR', 'snapshots'),
+        mode=mode,
+        fmt=os.getenv('SNAPSHOT_FORMAT', 'parquet'),
+        chunk_size=int(os.getenv('SNAPSHOT_CHUNK_SIZE', 10000)),
+        compression=os.getenv('SNAPSHOT_COMPRESSION', 'zstd')
+    )
+    if result.get("ok"):
+        logger.info(f"TASK SUCCESS | stock.export_snapshot | mode={result['mode']} | rows={result['rows']} | file={result['file']}")
+    else:
+        logger.error(f"TASK FAILED | stock.export_snapshot | error={result.get('message')}")
+    return shape_result(result_policy("stock.export_snapshot"), result)
@@ -0,0 +1,69 @@
+"""
+Stock change event relay
+
+Publishes the events recorded in the Stock outbox to Redis Streams,
+see app/services/outbox_relay.py.
+
+Usage:
+    python outbox_relay.py run      # relay until SIGTERM / Ctrl+C
+    python outbox_relay.py once     # publish a single batch
+    python outbox_relay.py lag      # entries the slowest consumer group is behind, per stream
+"""
+import argparse
+import os
+import signal
+import sys
+
+import redis
+
+from celery_app import logger
+from app.services.outbox_relay import OutboxRelay, DEFAULT_STREAM, stream_names
+
+OUTBOX_REDIS_URL = os.getenv(
+    "OUTBOX_REDIS_URL",
+    f"redis://{os.getenv('CELERY_BROKER_HOST', 'localhost')}:{os.getenv('CELERY_BROKER_PORT', 6379)}/0"
+)
+
+
+def build_relay():
+    """Relay configured from the environment"""
+    return OutboxRelay(
+        redis.Redis.from_url(OUTBOX_REDIS_URL),
+        stream=os.getenv("OUTBOX_STREAM", DEFAULT_STREAM),
+        partitions=int(os.getenv("OUTBOX_STREAM_PARTITIONS", 1)),
+        groups=[group.strip() for group in os.getenv("OUTBOX_CONSUMER_GROUPS", "").split(",") if group.strip()],
+        batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", 500)),
+        max_lag=int(os.getenv("OUTBOX_MAX_LAG", 10000)),
+        max_len=int(os.getenv("OUTBOX_STREAM_MAXLEN", 100000)),
+        poll_interval=float(os.getenv("OUTBOX_POLL_INTERVAL_S", 0.2)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stock change event relay")
+    parser.add_argument("command", choices=["run", "once", "lag"])
+    args = parser.parse_args()
+
+    relay = build_relay()
+    if args.command == "lag":
+        for name in stream_names(relay.stream, relay.partitions):
+            print(f"{name}\t{relay.lag(name)}")
+        return 0
+    if args.command == "once":
+        relay.ensure_groups()
+        logger.info(f"Outbox batch published | events={relay.relay_once()}")
+        return 0
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    logger.info(f"Outbox relay started | redis={OUTBOX_REDIS_URL} | stream={relay.stream} | partitions={relay.partitions}")
+    try:
+        relay.run(should_stop=lambda: bool(stopping))
+    except KeyboardInterrupt:
+        pass
+    logger.info("Outbox relay stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
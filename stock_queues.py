@@ -0,0 +1,59 @@
+"""
+Stock queue tooling
+
+Usage:
+    python stock_queues.py depths              # messages waiting per stock queue
+    python stock_queues.py drain [--timeout S] # wait until every stock queue is empty
+"""
+import argparse
+import sys
+import time
+
+from celery_app import celery, STOCK_QUEUE_PARTITIONS, logger
+from app.utils.partitioning import stock_queues
+
+
+def queue_depths(partitions=STOCK_QUEUE_PARTITIONS):
+    """Number of messages waiting in stock_queue and every stock_queue.<k>"""
+    depths = {}
+    with celery.connection_for_read() as conn:
+        channel = conn.default_channel
+        for queue in stock_queues(partitions):
+            try:
+                depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+            except Exception:
+                # queue was never declared, nothing routed there yet
+                depths[queue] = 0
+    return depths
+
+
+def drain(timeout, interval=1.0, partitions=STOCK_QUEUE_PARTITIONS):
+    """Block until every stock queue is empty, returns False on timeout"""
+    deadline = time.monotonic() + timeout
+    while True:
+        depths = queue_depths(partitions)
+        pending = sum(depths.values())
+        logger.info(f"Draining stock queues | pending={pending} | depths={depths}")
+        if pending == 0:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stock queue tooling")
+    parser.add_argument("command", choices=["depths", "drain"])
+    parser.add_argument("--partitions", type=int, default=STOCK_QUEUE_PARTITIONS)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    if args.command == "depths":
+        for queue, depth in queue_depths(args.partitions).items():
+            print(f"{queue}\t{depth}")
+        return 0
+    return 0 if drain(args.timeout, partitions=args.partitions) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
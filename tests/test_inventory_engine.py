@@ -0,0 +1,173 @@
+"""
+Inventory engine WAL tests
+
+Run without Mongo: persist_counters and fetch_counters are patched.
+
+    python -m unittest discover tests
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from app.services import inventory_engine
+from app.services.inventory_engine import EnginePartition, InventoryEngine, TIMEOUT_RESULT
+
+
+class PartitionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.wal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.wal_dir.cleanup)
+        self.persisted = []
+        self.persist_error = None
+        patcher = mock.patch.object(inventory_engine, "persist_counters", self._persist)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.partitions = []
+
+    def tearDown(self):
+        self.persist_error = None
+        for partition in self.partitions:
+            partition.stop()
+
+    def _persist(self, changes):
+        if not changes:
+            return
+        if self.persist_error is not None:
+            raise self.persist_error
+        self.persisted.append(dict(changes))
+
+    def partition(self, rows=(("p1", 100, 0),), start=True):
+        partition = EnginePartition(0, os.path.join(self.wal_dir.name, "partition-0.wal"), persist_retry_s=0.01)
+        if start:
+            partition.start(list(rows))
+            self.partitions.append(partition)
+        return partition
+
+    def segments(self):
+        return sorted(os.listdir(self.wal_dir.name))
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition not reached")
+            time.sleep(0.005)
+
+
+class WalReplayTest(PartitionTestCase):
+
+    def test_replays_segments_left_by_a_crash(self):
+        self.persist_error = RuntimeError("mongo down")
+        partition = self.partition()
+        for _ in range(3):
+            partition.submit("reserve", "p1", 2).result(1)
+        # simulate a crash: park the persister so the old partition never writes again
+        self.partitions.remove(partition)
+        partition.persist_retry_s = 3600
+        time.sleep(0.05)
+        self.persist_error = None
+        self.assertTrue(self.segments())
+
+        restarted = self.partition()
+        self.assertEqual(restarted.counters.snapshot("p1"), (94, 6))
+        self.assertIn({"p1": (94, 6)}, self.persisted)
+        # replayed segments are gone, only the new open one is left
+        self.assertEqual(self.segments(), ["partition-0.wal.%08d" % restarted.segment])
+
+    def test_ignores_a_torn_last_record(self):
+        path = os.path.join(self.wal_dir.name, "partition-0.wal.00000001")
+        with open(path, "w", encoding="utf-8") as wal:
+            wal.write('{"seq": 1, "pid": "p1", "a": 90, "r": 10}\n{"seq": 2, "pid": "p1", "a": 8')
+
+        partition = self.partition()
+        self.assertEqual(partition.counters.snapshot("p1"), (90, 10))
+        self.assertEqual(partition.segment, 2)
+
+
+class SegmentRotationTest(PartitionTestCase):
+
+    def test_persisted_segments_are_deleted(self):
+        partition = self.partition()
+        for _ in range(20):
+            partition.submit("reserve", "p1", 1).result(1)
+            self.wait_for(lambda: partition.persisted_seq == partition.seq)
+        self.wait_for(lambda: len(self.segments()) <= 2)
+        self.assertEqual(partition.counters.snapshot("p1"), (80, 20))
+        self.assertEqual(self.persisted[-1], {"p1": (80, 20)})
+
+    def test_segments_kept_while_mongo_is_down(self):
+        self.persist_error = RuntimeError("mongo down")
+        partition = self.partition()
+        for _ in range(5):
+            partition.submit("add", "p1", 1).result(1)
+            time.sleep(0.02)
+        self.assertGreater(len(self.segments()), 1)
+        self.assertEqual(partition.persisted_seq, 0)
+
+        self.persist_error = None
+        self.wait_for(lambda: partition.persisted_seq == partition.seq)
+        self.wait_for(lambda: len(self.segments()) == 1)
+
+
+class WalFailureTest(PartitionTestCase):
+
+    def test_failed_group_commit_fails_the_batch_and_later_operations(self):
+        partition = self.partition()
+        partition.submit("reserve", "p1", 1).result(1)
+        self.wait_for(lambda: partition.persisted_seq == partition.seq)
+
+        with mock.patch.object(inventory_engine.os, "fsync", side_effect=OSError(5, "Input/output error")):
+            with self.assertRaises(RuntimeError):
+                partition.submit("reserve", "p1", 5).result(1)
+
+        # rolled back and never written to Mongo
+        self.assertEqual(partition.counters.snapshot("p1"), (99, 1))
+        self.assertNotIn("p1", partition.dirty)
+        # later operations fail straight away instead of blocking
+        with self.assertRaises(RuntimeError):
+            partition.submit("add", "p1", 1).result(1)
+
+        # the failed record was cut from the segment, a restart doesn't apply it
+        self.partitions.remove(partition)
+        restarted = self.partition(rows=(("p1", 99, 1),))
+        self.assertEqual(restarted.counters.snapshot("p1"), (99, 1))
+
+    def test_closed_wal_does_not_block_callers(self):
+        partition = self.partition()
+        partition.wal.close()
+        with self.assertRaises(RuntimeError):
+            partition.submit("add", "p1", 1).result(1)
+        self.partitions.remove(partition)
+
+
+class DeadlineTest(PartitionTestCase):
+
+    def test_operation_expired_in_the_queue_is_not_applied(self):
+        partition = self.partition()
+        engine = InventoryEngine(1, [], self.wal_dir.name)
+        engine.owned = {0: partition}
+
+        release = threading.Event()
+        write = partition.wal.write
+
+        def slow_write(data):
+            release.wait(1)
+            return write(data)
+
+        with mock.patch.object(partition.wal, "write", slow_write):
+            first = partition.submit("reserve", "p1", 1)
+            time.sleep(0.05)
+            expired = partition.submit("reserve", "p1", 5, time.monotonic() + 0.01)
+            time.sleep(0.05)
+            release.set()
+            self.assertTrue(first.result(1)["ok"])
+            self.assertIs(expired.result(1), TIMEOUT_RESULT)
+        self.assertEqual(partition.counters.snapshot("p1"), (99, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()